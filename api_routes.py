@@ -1,22 +1,148 @@
+import json
 import os
-import subprocess
+import queue
+import time
+from concurrent.futures import Future
 from datetime import datetime
 
 import langcheck
 import pytz
 from dotenv import load_dotenv
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 
 import database as db
+import instrumentation
+import metric_cache
+import metric_events
+import metric_worker
+import model_registry
+import singleflight
 from calculate_metrics import add_init_to_db, get_factual_consistency
-from rag import RAG
+from rag import RAG, normalize_question
 
 api_routes_blueprint = Blueprint('api', __name__)
 load_dotenv()
 
+# How long a metrics stream waits for an event before re-reading the db
+METRICS_STREAM_RESYNC_SECONDS = 5
+# How long a metrics stream stays open before it ends and the client reconnects
+METRICS_STREAM_MAX_SECONDS = int(
+    os.environ.get('METRICS_STREAM_MAX_SECONDS', '300'))
+
 # Initialize the RAG system
 rag_system = RAG()
 
+# Load the local LangCheck models before the first chat, and before the metric
+# workers are forked so that they share the models
+model_registry.load(model_registry.get_languages())
+
+# Start the metric workers. With gunicorn's `preload_app`, each gunicorn worker
+# starts its own metric workers after it is forked instead (see
+# gunicorn.conf.py)
+if os.environ.get('METRIC_WORKER_START_AFTER_FORK', 'False') != 'True':
+    metric_worker.start()
+
+# Identical questions that are asked at the same time are answered once
+chat_flights = singleflight.SingleFlight()
+
+
+class ChatAnswer:
+    '''The answer to a question, along with its factual consistency score.
+    Identical questions asked at the same time share the same answer (see
+    `answer_chat`), but each one gets its own chat log.
+    '''
+
+    def __init__(self, response_message, source, score, explanation):
+        self.response_message = response_message
+        self.source = source
+        self.score = score
+        self.explanation = explanation
+        # The spans of answering the question (see instrumentation.trace),
+        # which are saved with the first chat log with this answer
+        self.timings = []
+        # Resolved once the metrics of the first chat log with this answer are
+        # computed, which puts them in the metric cache
+        self.metrics_computed = Future()
+
+
+def score_answer(response_message, source, language):
+    score, explanation = get_factual_consistency(response_message, source,
+                                                 language)
+    return ChatAnswer(response_message, source, score, explanation)
+
+
+def chat_key(path, user_message, language):
+    '''Returns the key that identifies identical questions, which are
+    coalesced unless CHAT_COALESCING_ENABLED is 'False'.
+    '''
+    if os.environ.get('CHAT_COALESCING_ENABLED', 'True') != 'True':
+        # A key that is never shared
+        return object()
+    return path, normalize_question(user_message), language
+
+
+def answer_chat(path, user_message, language):
+    '''Answers the question and computes the factual consistency score of the
+    answer. Returns the answer and whether it was shared with an identical
+    question that was being answered at the same time.
+    '''
+
+    def _answer():
+        with instrumentation.trace() as timings:
+            if path == '/api/chat_demo':
+                # Get canned responses to speed up live demos
+                response_message, source = rag_system.query_demo(
+                    user_message, language)
+            else:
+                response_message, source = rag_system.query(
+                    user_message, language)
+            answer = score_answer(response_message, source, language)
+        answer.timings = timings
+        return answer
+
+    return chat_flights.do(chat_key(path, user_message, language), _answer)
+
+
+def answer_chat_stream(path, user_message, language):
+    '''Same as `answer_chat`, but returns a stream of the tokens of the
+    response message as the LLM generates them (see `singleflight.Broadcast`),
+    whose result is the answer. Identical questions asked while the answer is
+    being generated read the same stream from its first token.
+    '''
+
+    def _answer(stream):
+        with instrumentation.trace() as timings:
+            if path == '/api/chat_demo_stream':
+                # Get canned responses to speed up live demos
+                response_gen, source = rag_system.query_demo_stream(
+                    user_message, language)
+            else:
+                response_gen, source = rag_system.query_stream(
+                    user_message, language)
+            tokens = []
+            for token in response_gen:
+                tokens.append(token)
+                stream.put(token)
+            answer = score_answer(''.join(tokens), source, language)
+        answer.timings = timings
+        return answer
+
+    return chat_flights.stream(chat_key(path, user_message, language), _answer)
+
+
+def release_shared_chats(stream):
+    '''Called when the request that started a streamed answer stops (e.g. its
+    client disconnects) before recording its chat log, so that the chat logs
+    that share the answer compute their metrics right away instead of waiting
+    for those of the first one (see `record_chat`).
+    '''
+
+    def _release(future):
+        if future.exception() is None:
+            future.result().metrics_computed.set_result(None)
+
+    stream.add_done_callback(_release)
+
 
 @api_routes_blueprint.route('/api/chat', methods=['POST'])
 @api_routes_blueprint.route('/api/chat_demo', methods=['POST'])
@@ -24,34 +150,90 @@ def chat():
     user_message = request.get_json().get('message', '')
     language = request.get_json().get('language', 'en')
 
-    if request.path == '/api/chat_demo':
-        # Get canned responses to speed up live demos
-        response_message, source = rag_system.query_demo(
-            user_message, language)
-    else:
-        response_message, source = rag_system.query(user_message, language)
+    answer, shared = answer_chat(request.path, user_message, language)
+    return jsonify(**record_chat(user_message, language, answer, shared))
+
+
+@api_routes_blueprint.route('/api/chat_stream', methods=['POST'])
+@api_routes_blueprint.route('/api/chat_demo_stream', methods=['POST'])
+def chat_stream():
+    '''Same as /api/chat, but streams the response as server-sent events.
+    A "token" event is sent for each chunk of the response message as the LLM
+    generates it, and a final "done" event carries the same fields as the
+    /api/chat response once the factual consistency score is computed.
+    '''
+    user_message = request.get_json().get('message', '')
+    language = request.get_json().get('language', 'en')
+
+    stream, shared = answer_chat_stream(request.path, user_message, language)
+
+    def generate():
+        recording = False
+        try:
+            for token in stream:
+                yield server_sent_event('token', {'token': token})
+            answer = stream.result()
+            recording = True
+            yield server_sent_event(
+                'done', record_chat(user_message, language, answer, shared))
+        finally:
+            if not shared and not recording:
+                release_shared_chats(stream)
 
-    # Compute the factual consistency score and add it along with the chat
-    # data to the db
-    factual_consistency_score, factual_consistency_explanation = get_factual_consistency(
-        response_message, source, language)
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={
+                        'Cache-Control': 'no-cache',
+                        'X-Accel-Buffering': 'no'
+                    })
 
+
+def server_sent_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def record_chat(user_message, language, answer, shared=False):
+    '''Records a chat turn and returns the fields of the /api/chat response.
+    '''
     timestamp = datetime.now(
         pytz.timezone('Asia/Tokyo')).strftime('%Y-%m-%d %H:%M:%S')
 
-    log_id = add_init_to_db(user_message, response_message, source, language,
-                            factual_consistency_score,
-                            factual_consistency_explanation, timestamp)
-
-    # Compute and log all the other metrics
-    subprocess.Popen(["python", "calculate_metrics.py", str(log_id)])
-    warning = factual_consistency_score < 0.5
+    if shared:
+        # Add the factual consistency score along with the chat data to the db
+        log_id = add_init_to_db(user_message, answer.response_message,
+                                answer.source, language, answer.score,
+                                answer.explanation, timestamp)
+        # Compute and log all the other metrics once those of the first chat
+        # log with the answer are done (or failed), so that they are read from
+        # the metric cache instead of being computed again
+        answer.metrics_computed.add_done_callback(
+            lambda _: metric_worker.submit_metrics(log_id))
+    else:
+        metrics_job = None
+        try:
+            log_id = add_init_to_db(user_message, answer.response_message,
+                                    answer.source, language, answer.score,
+                                    answer.explanation, timestamp)
+            metrics_job = metric_worker.submit_metrics(log_id)
+        finally:
+            # If this chat log couldn't be recorded, the ones that share the
+            # answer compute their metrics right away instead of waiting for it
+            if metrics_job is None:
+                answer.metrics_computed.set_result(None)
+            else:
+                metrics_job.add_done_callback(
+                    lambda _: answer.metrics_computed.set_result(None))
+        instrumentation.save_log_timings(log_id, answer.timings)
+    instrumentation.flush()
+    warning = answer.score < 0.5
 
-    return jsonify(response=response_message,
-                   score=factual_consistency_score,
-                   warning=warning,
-                   source=source,
-                   id=log_id)
+    return {
+        'response': answer.response_message,
+        'score': answer.score,
+        'warning': warning,
+        'source': answer.source,
+        'id': log_id
+    }
 
 
 @api_routes_blueprint.route('/api/ref_metric', methods=['POST'])
@@ -61,21 +243,53 @@ def get_reference_based_metric():
 
     # Update the status before updating the record
     db.update_chatlog_by_id({'status': 'new'}, log_id)
+    metric_events.publish_status(int(log_id), 'new')
 
     # Compute the metrics
-    subprocess.Popen([
-        "python", "calculate_reference_metrics.py",
-        str(log_id), reference_text
-    ])
+    metric_worker.submit_reference_metrics(int(log_id), reference_text)
     return jsonify(success=True)
 
 
 @api_routes_blueprint.route('/api/logs', methods=['GET'])
 def logs():
-    page = int(request.args.get('page', 1))
+    '''Returns a page of chat logs, newest first. Pages are selected either
+    with `page`, or with a `before=<timestamp>,<id>` cursor that stays fast at
+    any depth. The cursor of the next page is returned as `next_cursor`.
+    '''
     per_page = 10
-    offset = (page - 1) * per_page
-    return jsonify(logs=db.get_chatlogs_and_metrics(per_page, offset))
+    before = request.args.get('before')
+    if before is not None:
+        timestamp, id = before.rsplit(',', 1)
+        chat_logs = db.get_chatlogs_and_metrics(per_page,
+                                                before=(timestamp, int(id)))
+    else:
+        page = int(request.args.get('page', 1))
+        offset = (page - 1) * per_page
+        chat_logs = db.get_chatlogs_and_metrics(per_page, offset)
+
+    next_cursor = None
+    if len(chat_logs) == per_page:
+        next_cursor = f"{chat_logs[-1]['timestamp']},{chat_logs[-1]['id']}"
+    return jsonify(logs=chat_logs, next_cursor=next_cursor)
+
+
+@api_routes_blueprint.route('/api/metrics/summary', methods=['GET'])
+def metrics_summary():
+    '''Returns the count, mean, min, max and histogram (buckets of width 0.1)
+    of each metric per language and hour or day. This reads the rollups that
+    are maintained as metric values are written, so it doesn't scan the
+    `metric` table. Optional filters: `metric_name`, `language`, `start`,
+    `end` (inclusive, e.g. "2024-01-31" or "2024-01-31 09") and
+    `granularity` ("hour" or "day").
+    '''
+    granularity = request.args.get('granularity', 'hour')
+    if granularity not in ['hour', 'day']:
+        return jsonify({"error": "granularity must be hour or day"}), 400
+    summary = db.get_metric_summary(request.args.get('metric_name'),
+                                    request.args.get('language'),
+                                    request.args.get('start'),
+                                    request.args.get('end'), granularity)
+    return jsonify(summary=summary)
 
 
 @api_routes_blueprint.route('/api/metrics/<log_id>', methods=['GET'])
@@ -88,3 +302,109 @@ def metrics_endpoint(log_id):
         return jsonify({"error": "No chat logs available"}), 400
     metrics_data['status'] = chatlog_data['status']
     return jsonify(metrics_data)
+
+
+@api_routes_blueprint.route('/api/metrics/<int:log_id>/timings',
+                            methods=['GET'])
+def metrics_timings(log_id):
+    '''Returns the number of spans and the total seconds spent in each stage
+    of answering the question and computing the metrics of a chat log, slowest
+    first. These are only saved if INSTRUMENTATION_LOG_TIMINGS is 'True'.
+    '''
+    return jsonify(timings=db.get_log_timings(log_id))
+
+
+def get_metrics_snapshot(log_id):
+    '''Returns the metrics of a chat log along with its status, which is None
+    if there's no such chat log.
+    '''
+    metrics_data = db.get_metrics_by_log_id(log_id)
+    metrics_data['status'] = db.get_chatlog_by_id(log_id).get('status')
+    return metrics_data
+
+
+@api_routes_blueprint.route('/api/metrics/<int:log_id>/stream',
+                            methods=['GET'])
+def metrics_stream(log_id):
+    '''Streams the metrics of a chat log as server-sent events. A "snapshot"
+    event with the same fields as /api/metrics/<log_id> is sent first, followed
+    by a "metric" event for each metric value and a "status" event for each
+    status change as the metric workers write them. The stream ends once the
+    status is "done", or after METRICS_STREAM_MAX_SECONDS (the browser's
+    EventSource then reconnects).
+    '''
+
+    def generate():
+        # Subscribe before reading the snapshot so that no update is missed
+        subscriber = metric_events.subscribe(log_id)
+        deadline = time.monotonic() + METRICS_STREAM_MAX_SECONDS
+        try:
+            while True:
+                # Send the current state both at the start and whenever no
+                # event arrives for a while, since the metrics may be computed
+                # by the workers of another server process
+                metrics_data = get_metrics_snapshot(log_id)
+                yield server_sent_event('snapshot', metrics_data)
+                if metrics_data['status'] in ['done', None]:
+                    return
+                while True:
+                    timeout = min(METRICS_STREAM_RESYNC_SECONDS,
+                                  deadline - time.monotonic())
+                    if timeout <= 0:
+                        return
+                    try:
+                        event = subscriber.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if 'status' in event:
+                        yield server_sent_event('status', event)
+                        if event['status'] == 'done':
+                            return
+                        # Re-read the metrics, since their placeholders are
+                        # added right before the status becomes "pending"
+                        break
+                    else:
+                        yield server_sent_event('metric', event)
+        finally:
+            metric_events.unsubscribe(log_id, subscriber)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={
+                        'Cache-Control': 'no-cache',
+                        'X-Accel-Buffering': 'no'
+                    })
+
+
+@api_routes_blueprint.route('/api/metric_jobs/stats', methods=['GET'])
+def metric_jobs_stats():
+    return jsonify(metric_worker.stats())
+
+
+@api_routes_blueprint.route('/api/models/stats', methods=['GET'])
+def models_stats():
+    return jsonify(model_registry.stats())
+
+
+@api_routes_blueprint.route('/api/chat/coalescing/stats', methods=['GET'])
+def chat_coalescing_stats():
+    return jsonify(chat_flights.stats())
+
+
+@api_routes_blueprint.route('/api/answer_cache/stats', methods=['GET'])
+def answer_cache_stats():
+    return jsonify(rag_system.answer_cache.stats())
+
+
+@api_routes_blueprint.route('/api/metric_cache/stats', methods=['GET'])
+def metric_cache_stats():
+    return jsonify(metric_cache.stats())
+
+
+@api_routes_blueprint.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    '''Returns the histograms of the time spent in each stage (see
+    instrumentation.py) in the Prometheus text format.
+    '''
+    return Response(instrumentation.render_prometheus(),
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,233 @@
+'''Serves the app asynchronously, so that a chat waiting on the LLM doesn't hold
+a worker:
+
+    uvicorn asgi:app --host 127.0.0.1 --port 5000
+
+The chat routes (/api/chat, /api/chat_stream and their demo variants) are
+served by an event loop, which awaits the retrieval and LLM calls and runs the
+factual consistency score and the db insert on a thread pool. The streaming
+routes send each token as the LLM generates it, and like in the Flask app,
+identical questions asked at the same time are answered once by every chat
+route. The metric streams (/api/metrics/<log_id>/stream) wait for the metric
+events on the event loop too. Every other route is served by the Flask app as
+before.
+'''
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import database as db
+import instrumentation
+import metric_events
+from api_routes import (METRICS_STREAM_MAX_SECONDS,
+                        METRICS_STREAM_RESYNC_SECONDS, chat_flights, chat_key,
+                        get_metrics_snapshot, rag_system, record_chat,
+                        release_shared_chats, score_answer, server_sent_event)
+from app import app as flask_app
+
+load_dotenv()
+
+_EVENT_STREAM_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+# Threads that run the blocking parts of a chat (the factual consistency score
+# and the db insert). Each one mostly waits on the OpenAI API, so there can be
+# many more of them than CPUs
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASGI_EXECUTOR_THREADS', '200')))
+# Threads that serve the Flask routes
+_flask_threads = int(os.environ.get('ASGI_FLASK_THREADS', '32'))
+_flask_app = WSGIMiddleware(flask_app, workers=_flask_threads)
+
+
+async def _run_in_executor(fn, *args):
+    # Run in the context of the caller, so that the spans are included in the
+    # chat log's timings
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _executor, functools.partial(instrumentation.in_context(fn), *args))
+
+
+async def _answer(path, user_message, language):
+    '''Same as `api_routes.answer_chat`, but awaits the query.
+    '''
+    # /api/chat_demo gets canned responses to speed up live demos
+    is_demo = path == '/api/chat_demo'
+    with instrumentation.trace() as timings:
+        if os.environ['OPENAI_API_TYPE'] == 'local':
+            # llama.cpp generates on this machine's CPU and has no truly async
+            # API, so it runs on the thread pool instead
+            query = rag_system.query_demo if is_demo else rag_system.query
+            response_message, source = await _run_in_executor(
+                query, user_message, language)
+        else:
+            aquery = rag_system.aquery_demo if is_demo else rag_system.aquery
+            response_message, source = await aquery(user_message, language)
+        answer = await _run_in_executor(score_answer, response_message, source,
+                                        language)
+    answer.timings = timings
+    return answer
+
+
+async def chat(request):
+    body = await request.json()
+    user_message = body.get('message', '')
+    language = body.get('language', 'en')
+
+    # Identical questions asked at the same time share the same answer
+    path = request.url.path
+    answer, shared = await chat_flights.ado(
+        chat_key(path, user_message, language), _answer, path, user_message,
+        language)
+    chat_response = await _run_in_executor(record_chat, user_message, language,
+                                           answer, shared)
+    return JSONResponse(chat_response)
+
+
+async def _iterate_in_executor(iterator):
+    '''Yields the items of a blocking iterator, getting each one on the thread
+    pool.
+    '''
+    done = object()
+    while True:
+        item = await _run_in_executor(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+async def _query_stream(path, user_message, language):
+    '''Returns an async generator of the response message tokens and the
+    sources, like `RAG.aquery_stream`.
+    '''
+    # /api/chat_demo_stream gets canned responses to speed up live demos
+    is_demo = path == '/api/chat_demo_stream'
+    if os.environ['OPENAI_API_TYPE'] == 'local':
+        # llama.cpp has no truly async API (see `_answer`)
+        query_stream = (rag_system.query_demo_stream
+                        if is_demo else rag_system.query_stream)
+        response_gen, source = await _run_in_executor(query_stream,
+                                                      user_message, language)
+        return _iterate_in_executor(response_gen), source
+    aquery_stream = (rag_system.aquery_demo_stream
+                     if is_demo else rag_system.aquery_stream)
+    return await aquery_stream(user_message, language)
+
+
+async def _answer_stream(stream, path, user_message, language):
+    '''Same as `api_routes.answer_chat_stream`, but awaits the query and each
+    token.
+    '''
+    with instrumentation.trace() as timings:
+        response_gen, source = await _query_stream(path, user_message,
+                                                   language)
+        tokens = []
+        async for token in response_gen:
+            tokens.append(token)
+            stream.put(token)
+        answer = await _run_in_executor(score_answer, ''.join(tokens), source,
+                                        language)
+    answer.timings = timings
+    return answer
+
+
+async def chat_stream(request):
+    '''Same as `api_routes.chat_stream`, but awaits each token.
+    '''
+    body = await request.json()
+    user_message = body.get('message', '')
+    language = body.get('language', 'en')
+
+    # Identical questions asked at the same time share the same stream
+    path = request.url.path
+    stream, shared = chat_flights.astream(
+        chat_key(path, user_message, language), _answer_stream, path,
+        user_message, language)
+
+    async def generate():
+        recording = False
+        try:
+            async for token in stream.aiter():
+                yield server_sent_event('token', {'token': token})
+            answer = await stream.aresult()
+            recording = True
+            chat_response = await _run_in_executor(record_chat, user_message,
+                                                   language, answer, shared)
+            yield server_sent_event('done', chat_response)
+        finally:
+            if not shared and not recording:
+                release_shared_chats(stream)
+
+    return StreamingResponse(generate(),
+                             media_type='text/event-stream',
+                             headers=_EVENT_STREAM_HEADERS)
+
+
+async def metrics_stream(request):
+    '''Same as `api_routes.metrics_stream`, but awaits the metric events.
+    '''
+    log_id = request.path_params['log_id']
+
+    async def generate():
+        loop = asyncio.get_running_loop()
+        # Subscribe before reading the snapshot so that no update is missed
+        subscriber = metric_events.asubscribe(log_id)
+        deadline = loop.time() + METRICS_STREAM_MAX_SECONDS
+        try:
+            while True:
+                metrics_data = await _run_in_executor(get_metrics_snapshot,
+                                                      log_id)
+                yield server_sent_event('snapshot', metrics_data)
+                if metrics_data['status'] in ['done', None]:
+                    return
+                while True:
+                    timeout = min(METRICS_STREAM_RESYNC_SECONDS,
+                                  deadline - loop.time())
+                    if timeout <= 0:
+                        return
+                    try:
+                        event = await asyncio.wait_for(subscriber.get(),
+                                                       timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if 'status' in event:
+                        yield server_sent_event('status', event)
+                        if event['status'] == 'done':
+                            return
+                        break
+                    else:
+                        yield server_sent_event('metric', event)
+        finally:
+            metric_events.unsubscribe(log_id, subscriber)
+
+    return StreamingResponse(generate(),
+                             media_type='text/event-stream',
+                             headers=_EVENT_STREAM_HEADERS)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    db.initialize_db()
+    yield
+    _executor.shutdown(wait=False)
+
+
+routes = [
+    Route('/api/chat', chat, methods=['POST']),
+    Route('/api/chat_demo', chat, methods=['POST']),
+    Route('/api/chat_stream', chat_stream, methods=['POST']),
+    Route('/api/chat_demo_stream', chat_stream, methods=['POST']),
+    Route('/api/metrics/{log_id:int}/stream', metrics_stream, methods=['GET']),
+    Mount('/', app=_flask_app)
+]
+app = Starlette(routes=routes, lifespan=lifespan)
@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import traceback
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+from dotenv import load_dotenv
+
+import database as db
+import instrumentation
+import metric_events
+from calculate_metrics import (BATCHABLE_LOCAL_METRICS, load_local_models,
+                               mark_done_if_complete)
+
+load_dotenv()
+
+# How long the batcher waits after failing to read the pending metrics (e.g.
+# because the database is locked), doubling up to the maximum while it keeps
+# failing
+ERROR_BACKOFF_SECONDS = 1.0
+MAX_ERROR_BACKOFF_SECONDS = 30.0
+
+
+def compute_batch(metric_name: str, language: str,
+                  rows: List[Dict[str, Any]]) -> None:
+    '''Computes a local metric for many chat logs with a single call to the
+    langcheck metric function, and writes the values back to their rows.
+    '''
+    metric_fns, columns = BATCHABLE_LOCAL_METRICS[metric_name]
+    metric_fn = metric_fns[language]
+    args = [[row[column] for row in rows] for column in columns]
+    try:
+        load_local_models(language)
+        with instrumentation.span('metric_batch', metric_name, language):
+            metric_values = metric_fn(*args).metric_values
+    except Exception:
+        # Store the rows without a value, like a metric that the model can't
+        # score, so that their chat logs are still marked as done
+        print(f'Failed to compute {metric_name} ({language}):',
+              file=sys.stderr)
+        traceback.print_exc()
+        metric_values = [None] * len(rows)
+    db.update_metrics([(value, None, row['id'])
+                       for row, value in zip(rows, metric_values)])
+    for row, value in zip(rows, metric_values):
+        metric_events.publish_metric(row['log_id'], metric_name, value, None)
+    for log_id in {row['log_id'] for row in rows}:
+        mark_done_if_complete(log_id)
+
+
+class MetricBatcher:
+    '''Collects pending local metrics from the `metric` table and computes them
+    in batches grouped by (metric name, language).
+
+    A group is computed as soon as it has `batch_size` rows, or once its oldest
+    row has waited for `max_wait_seconds`, so a larger batch size trades
+    latency for throughput.
+    '''
+
+    def __init__(self, batch_size: int, max_wait_seconds: float):
+        self.batch_size = batch_size
+        self.max_wait_seconds = max_wait_seconds
+        # When each pending metric row was first seen
+        self._first_seen: Dict[int, float] = {}
+
+    def run_once(self) -> int:
+        '''Computes the groups that are ready and returns the number of rows
+        computed.
+        '''
+        now = time.monotonic()
+        groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = defaultdict(list)
+        for row in db.get_pending_metrics(list(BATCHABLE_LOCAL_METRICS)):
+            self._first_seen.setdefault(row['id'], now)
+            groups[(row['metric_name'], row['language'])].append(row)
+
+        num_computed = 0
+        for (metric_name, language), rows in groups.items():
+            oldest = min(self._first_seen[row['id']] for row in rows)
+            if (len(rows) < self.batch_size
+                    and now - oldest < self.max_wait_seconds):
+                continue
+            for i in range(0, len(rows), self.batch_size):
+                batch = rows[i:i + self.batch_size]
+                try:
+                    compute_batch(metric_name, language, batch)
+                    num_computed += len(batch)
+                except Exception:
+                    # The values couldn't be written, so the rows are still
+                    # pending and are retried on the next run
+                    print(f'Failed to save {metric_name} ({language}):',
+                          file=sys.stderr)
+                    traceback.print_exc()
+                    continue
+                for row in batch:
+                    self._first_seen.pop(row['id'], None)
+        return num_computed
+
+    def run_forever(self) -> None:
+        poll_interval = min(self.max_wait_seconds, 0.1)
+        backoff = ERROR_BACKOFF_SECONDS
+        while True:
+            try:
+                num_computed = self.run_once()
+            except Exception:
+                # Nothing restarts the batcher, so it keeps going. The pending
+                # rows are read again on the next run
+                print('Failed to compute the pending metrics:',
+                      file=sys.stderr)
+                traceback.print_exc()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_ERROR_BACKOFF_SECONDS)
+                continue
+            backoff = ERROR_BACKOFF_SECONDS
+            if num_computed == 0:
+                time.sleep(poll_interval)
+            instrumentation.flush()
+
+
+def main():
+    batcher = MetricBatcher(
+        int(os.environ.get('METRIC_BATCH_SIZE', '32')),
+        float(os.environ.get('METRIC_BATCH_MAX_WAIT_SECONDS', '0.5')))
+    batcher.run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+'''A local stand-in for the OpenAI and Azure OpenAI APIs, so that the app can be
+benchmarked without the network and without the latency of the real API
+dominating (or varying between) runs.
+
+It serves the chat completions API (including streaming and function calling,
+which the LangCheck metrics use) and the embeddings API, with a configurable
+latency and error rate. Embeddings are bag-of-words hashes of the input, so
+texts that share words get similar embeddings.
+
+    python benchmarks/fake_openai.py --port 8900 --latency 0.5 --error-rate 0.01
+'''
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+WORDS = ('the a of to and in is for that with as on by it this are be from '
+         'metric model language check score text response source answer '
+         'question evaluate consistency toxicity fluency sentiment library '
+         'python function result value data output input document').split()
+
+
+def _embed(text: str, dim: int) -> List[float]:
+    vector = [0.0] * dim
+    for word in re.findall(r'\w+', text.lower()):
+        digest = hashlib.md5(word.encode('utf-8')).digest()
+        index = int.from_bytes(digest[:4], 'little') % dim
+        vector[index] += 1.0 if digest[4] % 2 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def _function_arguments(parameters: Dict[str, Any]) -> str:
+    '''Returns arguments that satisfy the JSON schema of a function, choosing
+    randomly among the allowed values so that the metrics vary.
+    '''
+    arguments = {}
+    for name, schema in parameters.get('properties', {}).items():
+        if 'enum' in schema:
+            arguments[name] = random.choice(schema['enum'])
+        elif schema.get('type') in ['number', 'integer']:
+            arguments[name] = random.random()
+        else:
+            arguments[name] = ' '.join(random.choices(WORDS, k=8))
+    return json.dumps(arguments)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Set by main()
+    config: argparse.Namespace
+
+    def log_message(self, format, *args):
+        return
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        path = self.path.split('?')[0]
+        if path.endswith('/chat/completions'):
+            latency = self.config.latency
+        elif path.endswith('/embeddings'):
+            latency = self.config.embedding_latency
+        else:
+            error = {'message': f'Unknown path {path}'}
+            self._send_json(404, {'error': error})
+            return
+
+        time.sleep(latency * random.uniform(0.5, 1.5))
+        if random.random() < self.config.error_rate:
+            error = {'message': 'Injected error', 'type': 'fake_error'}
+            self._send_json(self.config.error_status, {'error': error},
+                            {'retry-after-ms': '10'})
+        elif path.endswith('/embeddings'):
+            self._send_json(200, self._embeddings(body))
+        elif body.get('stream'):
+            self._stream_chat_completion(body)
+        else:
+            self._send_json(200, self._chat_completion(body))
+
+    def _embeddings(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        inputs = body['input']
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        data = []
+        for i, text in enumerate(inputs):
+            embedding: Any = _embed(str(text), self.config.embedding_dim)
+            if body.get('encoding_format') == 'base64':
+                packed = struct.pack(f'<{len(embedding)}f', *embedding)
+                embedding = base64.b64encode(packed).decode('ascii')
+            data.append({
+                'object': 'embedding',
+                'index': i,
+                'embedding': embedding
+            })
+        return {
+            'object': 'list',
+            'data': data,
+            'model': body.get('model', 'fake'),
+            'usage': {
+                'prompt_tokens': 0,
+                'total_tokens': 0
+            }
+        }
+
+    def _chat_completion(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        message: Dict[str, Any] = {'role': 'assistant', 'content': None}
+        finish_reason = 'stop'
+        if body.get('functions'):
+            function = body['functions'][0]
+            message['function_call'] = {
+                'name': function['name'],
+                'arguments': _function_arguments(function['parameters'])
+            }
+            finish_reason = 'function_call'
+        elif body.get('tools'):
+            function = body['tools'][0]['function']
+            message['tool_calls'] = [{
+                'id': f'call_{uuid.uuid4().hex}',
+                'type': 'function',
+                'function': {
+                    'name': function['name'],
+                    'arguments': _function_arguments(function['parameters'])
+                }
+            }]
+            finish_reason = 'tool_calls'
+        else:
+            message['content'] = self._response_text()
+        choice = {
+            'index': 0,
+            'message': message,
+            'finish_reason': finish_reason,
+            'logprobs': None
+        }
+        return {
+            'id': f'chatcmpl-{uuid.uuid4().hex}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [choice],
+            'usage': {
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+                'total_tokens': 0
+            }
+        }
+
+    def _stream_chat_completion(self, body: Dict[str, Any]) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        id = f'chatcmpl-{uuid.uuid4().hex}'
+        words = self._response_text().split(' ')
+        deltas = [{'role': 'assistant', 'content': ''}]
+        deltas += [{'content': word + ' '} for word in words]
+        for i, delta in enumerate(deltas + [{}]):
+            choice = {
+                'index': 0,
+                'delta': delta,
+                'finish_reason': None if delta else 'stop'
+            }
+            chunk = {
+                'id': id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [choice]
+            }
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            if i > 0:
+                time.sleep(self.config.token_latency)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+    def _response_text(self) -> str:
+        return ' '.join(random.choices(WORDS, k=self.config.response_words))
+
+    def _send_json(self,
+                   status: int,
+                   body: Dict[str, Any],
+                   headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def parse_args(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Serve a fake OpenAI API for benchmarks.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.5,
+                        help='Mean seconds per chat completion')
+    parser.add_argument('--embedding-latency',
+                        type=float,
+                        default=0.05,
+                        help='Mean seconds per embeddings request')
+    parser.add_argument('--token-latency',
+                        type=float,
+                        default=0.01,
+                        help='Seconds between streamed tokens')
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of requests that fail')
+    parser.add_argument('--error-status',
+                        type=int,
+                        default=429,
+                        help='HTTP status of the failed requests')
+    parser.add_argument('--response-words', type=int, default=80)
+    parser.add_argument('--embedding-dim', type=int, default=1536)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    config = parse_args(args)
+    FakeOpenAIHandler.config = config
+    server = ThreadingHTTPServer((config.host, config.port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    print(f'Serving a fake OpenAI API on http://{config.host}:{config.port}',
+          flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,482 @@
+'''Benchmarks the latency and throughput of the chat and metrics pipeline
+against a local fake of the OpenAI API (see fake_openai.py), so that it runs
+without the network and its results can be compared across commits.
+
+The benchmark works in a scratch directory with its own database, seeded with
+--seed-logs chat logs, and its own generated documents. It runs these
+scenarios:
+
+- chat: POST /api/chat to the app served by --server, from --concurrency
+  clients at once. How long each chat log then takes until its metrics are
+  done is reported as metric_completion.
+- metrics: `calculate_metrics.main` on new chat logs, called in this process
+  from --concurrency threads at once.
+- logs: `database.get_chatlogs_and_metrics` for pages at random depths, by
+  offset (logs_offset) and by cursor (logs_cursor).
+
+The metrics and chat scenarios need the local model of ai_disclaimer_similarity
+(and with --local-models, the other local LangCheck models) in the Hugging Face
+cache, since the benchmark runs offline.
+
+The results are printed and saved as JSON, and compared with the results of a
+previous run if --compare is given:
+
+    python benchmarks/run.py --compare benchmarks/results/<previous run>.json
+'''
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from fake_openai import WORDS
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+sys.path.insert(0, REPO_DIR)
+
+LANGUAGES = ['en', 'ja', 'de', 'zh']
+# The metrics that a chat log has once it's done, with local models disabled
+SEEDED_METRICS = [
+    'factual_consistency_openai', 'context_relevance_openai',
+    'answer_relevance_openai', 'request_toxicity_openai',
+    'response_toxicity_openai', 'request_sentiment_openai',
+    'response_sentiment_openai', 'request_fluency_openai',
+    'response_fluency_openai', 'request_readability', 'response_readability',
+    'ai_disclaimer_similarity'
+]
+# The summary statistics compared by --compare
+COMPARED_STATISTICS = ['p50_ms', 'p95_ms', 'p99_ms', 'requests_per_second']
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _summarize(latencies: List[float], elapsed: float,
+               errors: int) -> Dict[str, Any]:
+    '''Returns the count, error count, latency percentiles in milliseconds and
+    throughput of a scenario.
+    '''
+    latencies = sorted(latencies)
+    summary: Dict[str, Any] = {
+        'count': len(latencies),
+        'errors': errors,
+        'requests_per_second': len(latencies) / elapsed
+    }
+    if latencies:
+        for percent in [50, 95, 99]:
+            summary[f'p{percent}_ms'] = _percentile(latencies, percent) * 1000
+        summary['mean_ms'] = sum(latencies) / len(latencies) * 1000
+    return summary
+
+
+def _time_concurrently(fn: Callable[[Any], Any], inputs: List[Any],
+                       concurrency: int) -> Dict[str, Any]:
+    '''Calls `fn` on each input from `concurrency` threads at once, and
+    returns the summary of the latencies of the calls that succeeded.
+    '''
+    latencies = []
+    errors = 0
+
+    def _timed(input):
+        start = time.perf_counter()
+        fn(input)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(_timed, input) for input in inputs]
+        for future in futures:
+            if future.exception() is None:
+                latencies.append(future.result())
+            else:
+                errors += 1
+    return _summarize(latencies, time.perf_counter() - start, errors)
+
+
+def _random_text(rng: random.Random, num_words: int) -> str:
+    return ' '.join(rng.choices(WORDS, k=num_words)).capitalize() + '.'
+
+
+def _make_workdir(workdir: Optional[str], num_documents: int,
+                  rng: random.Random) -> str:
+    '''Creates the scratch directory that the app runs in, with the database
+    schemas, the demo responses and generated documents.
+    '''
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='langcheckchat-benchmark-')
+    shutil.copytree(os.path.join(REPO_DIR, 'db'),
+                    os.path.join(workdir, 'db'),
+                    ignore=shutil.ignore_patterns('*.db*'),
+                    dirs_exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, 'demo_responses.json'), workdir)
+    os.makedirs(os.path.join(workdir, 'docs'), exist_ok=True)
+    for i in range(num_documents):
+        paragraphs = [_random_text(rng, 60) for _ in range(10)]
+        with open(os.path.join(workdir, 'docs', f'doc_{i}.md'), 'w') as f:
+            f.write(f'# Document {i}\n\n' + '\n\n'.join(paragraphs))
+    return workdir
+
+
+def _wait_for(is_ready: Callable[[], bool], timeout: float,
+              process: subprocess.Popen, name: str) -> None:
+    deadline = time.time() + timeout
+    while not is_ready():
+        if process.poll() is not None:
+            raise RuntimeError(f'{name} exited with code {process.returncode}')
+        if time.time() > deadline:
+            raise RuntimeError(f'{name} did not start in {timeout} seconds')
+        time.sleep(0.5)
+
+
+def _is_listening(port: int) -> bool:
+    with socket.socket() as s:
+        return s.connect_ex(('127.0.0.1', port)) == 0
+
+
+def _post_json(url: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(data).encode('utf-8'),
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=300) as response:
+        return json.loads(response.read())
+
+
+def check_local_model(calculate_metrics) -> None:
+    '''Exits if the local model of ai_disclaimer_similarity, which is computed
+    for every chat log even without --local-models, can't be loaded from the
+    Hugging Face cache. Every metrics job would fail otherwise, so the chat
+    logs would never be done.
+    '''
+    try:
+        calculate_metrics.AI_DISCLAIMER_SIMILARITY_FNS['en'](['Hello'])
+    except Exception as e:
+        sys.exit('The local model of ai_disclaimer_similarity is not in the '
+                 f'Hugging Face cache ({e!r}). Download it once with network '
+                 'access by running:\n'
+                 '    python -c "import langcheck; '
+                 "langcheck.metrics.ai_disclaimer_similarity(['Hello'])\"")
+
+
+def seed_logs(db, num_logs: int, rng: random.Random) -> List[Tuple[str, int]]:
+    '''Inserts chat logs with their metrics done, one every 30 seconds, and
+    returns their (timestamp, id) pairs.
+    '''
+    start = datetime(2024, 1, 1)
+    seeded = []
+    for i in range(num_logs):
+        timestamp = (start +
+                     timedelta(seconds=30 * i)).strftime('%Y-%m-%d %H:%M:%S')
+        chat_log = {
+            'request': _random_text(rng, 12),
+            'response': _random_text(rng, 80),
+            'source': _random_text(rng, 300),
+            'language': rng.choice(LANGUAGES),
+            'timestamp': timestamp,
+            'status': 'done'
+        }
+        metrics = [(metric_name, rng.random(), None)
+                   for metric_name in SEEDED_METRICS]
+        seeded.append((timestamp, db.insert_chatlog(chat_log, metrics)))
+        if (i + 1) % 10000 == 0:
+            print(f'Seeded {i + 1}/{num_logs} chat logs', flush=True)
+    return seeded
+
+
+def run_logs(db, seeded: List[Tuple[str, int]], args: argparse.Namespace,
+             rng: random.Random) -> Dict[str, Dict[str, Any]]:
+    # Newest first, like the logs page
+    seeded = sorted(seeded, reverse=True)
+    depths = [rng.randrange(len(seeded)) for _ in range(args.log_queries)]
+    logs_offset = _time_concurrently(
+        lambda depth: db.get_chatlogs_and_metrics(10, depth), depths, 1)
+    logs_cursor = _time_concurrently(
+        lambda depth: db.get_chatlogs_and_metrics(10, before=seeded[depth]),
+        depths, 1)
+    return {'logs_offset': logs_offset, 'logs_cursor': logs_cursor}
+
+
+def run_metrics(db, calculate_metrics, args: argparse.Namespace,
+                rng: random.Random) -> Dict[str, Dict[str, Any]]:
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    chat_logs = [{
+        'request': _random_text(rng, 12),
+        'response': _random_text(rng, 80),
+        'source': _random_text(rng, 300),
+        'language': 'en',
+        'timestamp': timestamp
+    } for _ in range(args.metric_logs)]
+    log_ids = db.insert_chatlogs(chat_logs)
+    metrics = _time_concurrently(calculate_metrics.main, log_ids,
+                                 args.concurrency)
+    return {'metrics': metrics}
+
+
+def run_chat(database_path: str, args: argparse.Namespace,
+             rng: random.Random) -> Dict[str, Dict[str, Any]]:
+    '''Sends chats to the app, and polls the database for the chat logs whose
+    metrics are done.
+    '''
+    url = f'http://127.0.0.1:{args.app_port}'
+    questions = [
+        _random_text(rng, 12) + '?' for _ in range(args.chat_requests)
+    ]
+    # Maps the id of each chat log whose metrics aren't done yet to the time
+    # its chat response was received
+    pending: Dict[int, float] = {}
+    pending_lock = threading.Lock()
+    completion_latencies = []
+    chats_done = threading.Event()
+
+    def _chat(question):
+        response = _post_json(f'{url}/api/chat', {
+            'message': question,
+            'language': 'en'
+        })
+        with pending_lock:
+            pending[response['id']] = time.perf_counter()
+
+    def _poll_metrics():
+        conn = sqlite3.connect(database_path)
+        deadline = None
+        while True:
+            with pending_lock:
+                log_ids = list(pending)
+            if log_ids:
+                placeholders = ', '.join('?' for _ in log_ids)
+                query = f'''
+                    SELECT id FROM chat_log
+                    WHERE id IN ({placeholders}) AND status = 'done'
+                '''
+                done = [row[0] for row in conn.execute(query, log_ids)]
+                now = time.perf_counter()
+                with pending_lock:
+                    for log_id in done:
+                        completion_latencies.append(now - pending.pop(log_id))
+            if chats_done.is_set():
+                deadline = deadline or time.time() + args.metric_timeout
+                if not pending or time.time() > deadline:
+                    break
+            time.sleep(0.05)
+        conn.close()
+
+    for _ in range(args.warmup_requests):
+        _post_json(f'{url}/api/chat', {'message': 'Warm up', 'language': 'en'})
+    poller = threading.Thread(target=_poll_metrics)
+    start = time.perf_counter()
+    poller.start()
+    chat = _time_concurrently(_chat, questions, args.concurrency)
+    chats_done.set()
+    poller.join()
+    metric_completion = _summarize(completion_latencies,
+                                   time.perf_counter() - start, len(pending))
+    return {'chat': chat, 'metric_completion': metric_completion}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=REPO_DIR,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: Dict[str, Dict[str, Any]],
+                  previous: Optional[Dict[str, Dict[str, Any]]]) -> None:
+    for scenario, summary in results.items():
+        print(f"{scenario} ({summary['count']} ok, "
+              f"{summary['errors']} errors)")
+        previous_summary = (previous or {}).get(scenario, {})
+        for statistic in COMPARED_STATISTICS:
+            value = summary.get(statistic)
+            if value is None:
+                print(f'  {statistic:<20} {"-":>10}')
+                continue
+            line = f'  {statistic:<20} {value:10.1f}'
+            previous_value = previous_summary.get(statistic)
+            if previous_value:
+                change = (value - previous_value) / previous_value * 100
+                line += f'  (was {previous_value:.1f}, {change:+.1f}%)'
+            print(line)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the chat and metrics pipeline.')
+    parser.add_argument('--scenarios',
+                        default='logs,metrics,chat',
+                        help='Comma-separated scenarios to run')
+    parser.add_argument('--seed-logs',
+                        type=int,
+                        default=20000,
+                        help='Number of chat logs to seed the database with')
+    parser.add_argument('--log-queries', type=int, default=200)
+    parser.add_argument('--metric-logs', type=int, default=50)
+    parser.add_argument('--chat-requests', type=int, default=200)
+    parser.add_argument('--warmup-requests', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--server',
+                        choices=['gunicorn', 'uvicorn'],
+                        default='gunicorn',
+                        help='Serve the app with gunicorn (app.py) or with '
+                        'uvicorn (asgi.py)')
+    parser.add_argument('--num-documents', type=int, default=50)
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.5,
+                        help='Mean seconds per fake chat completion')
+    parser.add_argument('--embedding-latency',
+                        type=float,
+                        default=0.05,
+                        help='Mean seconds per fake embeddings request')
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of fake API requests that fail')
+    parser.add_argument('--local-models',
+                        action='store_true',
+                        help='Enable the local LangCheck models, which must '
+                        'already be in the Hugging Face cache')
+    parser.add_argument('--metric-timeout',
+                        type=float,
+                        default=300,
+                        help='Seconds to wait for the metrics after the '
+                        'last chat')
+    parser.add_argument('--startup-timeout', type=float, default=600)
+    parser.add_argument('--fake-openai-port', type=int, default=8900)
+    parser.add_argument('--app-port', type=int, default=8901)
+    parser.add_argument('--workdir',
+                        help='Scratch directory to reuse instead of a new '
+                        'temporary one, which is kept')
+    parser.add_argument('--output', help='Path of the results JSON file')
+    parser.add_argument('--compare',
+                        help='Path of the results of a previous run')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    # The benchmark runs in the scratch directory
+    output = args.output and os.path.abspath(args.output)
+    compare = args.compare and os.path.abspath(args.compare)
+    scenarios = args.scenarios.split(',')
+    rng = random.Random(args.seed)
+    workdir = _make_workdir(args.workdir, args.num_documents, rng)
+    processes = []
+    try:
+        fake_openai_script = os.path.join(REPO_DIR, 'benchmarks',
+                                          'fake_openai.py')
+        fake_openai = subprocess.Popen([
+            sys.executable, fake_openai_script, '--port',
+            str(args.fake_openai_port), '--latency',
+            str(args.latency), '--embedding-latency',
+            str(args.embedding_latency), '--error-rate',
+            str(args.error_rate)
+        ])
+        processes.append(fake_openai)
+        _wait_for(lambda: _is_listening(args.fake_openai_port), 30,
+                  fake_openai, 'The fake OpenAI API')
+
+        # Point both the app and this process at the fake API and the scratch
+        # directory. These take precedence over .env, which doesn't override
+        # variables that are already set
+        fake_openai_url = f'http://127.0.0.1:{args.fake_openai_port}/v1'
+        enable_local_models = 'True' if args.local_models else 'False'
+        os.environ.update({
+            'OPENAI_API_TYPE': 'openai',
+            'OPENAI_API_KEY': 'benchmark',
+            'OPENAI_API_BASE': fake_openai_url,
+            'OPENAI_BASE_URL': fake_openai_url,
+            'LANGCHECK_OPENAI_API_TYPE': 'openai',
+            'LANGCHECK_OPENAI_API_KEY': 'benchmark',
+            'ENABLE_LOCAL_LANGCHECK_MODELS': enable_local_models,
+            'RAG_DOCUMENT_SOURCES': os.path.join(workdir, 'docs'),
+            'HF_HUB_OFFLINE': '1',
+            'TRANSFORMERS_OFFLINE': '1',
+            'PYTHONPATH': REPO_DIR
+        })
+        os.chdir(workdir)
+        # Imported only now, since the app's modules read the environment when
+        # they are imported
+        import database as db
+
+        import calculate_metrics
+
+        if 'metrics' in scenarios or 'chat' in scenarios:
+            check_local_model(calculate_metrics)
+        db.initialize_db()
+        seeded = seed_logs(db, args.seed_logs, rng)
+        results = {}
+        if 'logs' in scenarios:
+            results.update(run_logs(db, seeded, args, rng))
+        if 'metrics' in scenarios:
+            results.update(run_metrics(db, calculate_metrics, args, rng))
+        if 'chat' in scenarios:
+            if args.server == 'uvicorn':
+                app_command = [
+                    sys.executable, '-m', 'uvicorn', 'asgi:app', '--host',
+                    '127.0.0.1', '--port',
+                    str(args.app_port)
+                ]
+            else:
+                gunicorn_config = os.path.join(REPO_DIR, 'gunicorn.conf.py')
+                app_command = [
+                    sys.executable, '-m', 'gunicorn', 'app:app', '--config',
+                    gunicorn_config, '--bind', f'127.0.0.1:{args.app_port}'
+                ]
+            app = subprocess.Popen(app_command, cwd=workdir)
+            processes.append(app)
+            _wait_for(lambda: _is_listening(args.app_port),
+                      args.startup_timeout, app, 'The app')
+            results.update(
+                run_chat(os.path.join(workdir, db.DATABASE_URL), args, rng))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    previous = None
+    if compare:
+        with open(compare, 'r') as f:
+            previous = json.load(f)['results']
+    print_results(results, previous)
+
+    commit = _git_commit()
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        file_name = datetime.now().strftime('%Y%m%d-%H%M%S')
+        if commit is not None:
+            file_name += f'-{commit[:8]}'
+        output = os.path.join(RESULTS_DIR, file_name + '.json')
+    saved_results = {
+        'commit': commit,
+        'created_at': datetime.now().isoformat(),
+        'config': vars(args),
+        'results': results
+    }
+    with open(output, 'w') as f:
+        json.dump(saved_results, f, indent=2)
+    print(f'Saved the results to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,201 @@
 import os
+import random
+import re
 import sys
-from typing import Optional, Tuple
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Collection, Dict, List, Optional, Tuple
 
+import httpx
 import langcheck.metrics
 from dotenv import load_dotenv
-from openai import AzureOpenAI, OpenAI
+from openai import AzureOpenAI, OpenAI, RateLimitError
+from transformers import AutoTokenizer
 
 import database as db
+import instrumentation
+import metric_cache
+import metric_events
 
 load_dotenv()
 
+FACTUAL_CONSISTENCY_FNS = {
+    'en': langcheck.metrics.factual_consistency,
+    'ja': langcheck.metrics.ja.factual_consistency,
+    'de': langcheck.metrics.de.factual_consistency,
+    'zh': langcheck.metrics.zh.factual_consistency
+}
+TOXICITY_FNS = {
+    'en': langcheck.metrics.toxicity,
+    'ja': langcheck.metrics.ja.toxicity,
+    'de': langcheck.metrics.de.toxicity,
+    'zh': langcheck.metrics.zh.toxicity
+}
+SENTIMENT_FNS = {
+    'en': langcheck.metrics.sentiment,
+    'ja': langcheck.metrics.ja.sentiment,
+    'de': langcheck.metrics.de.sentiment,
+    'zh': langcheck.metrics.zh.sentiment
+}
+FLUENCY_FNS = {
+    'en': langcheck.metrics.fluency,
+    'ja': langcheck.metrics.ja.fluency,
+    'de': langcheck.metrics.de.fluency
+}
+# TODO: Use japanese and chinese metrics once implemented
+AI_DISCLAIMER_SIMILARITY_FNS = {
+    'en': langcheck.metrics.ai_disclaimer_similarity,
+    'ja': langcheck.metrics.ai_disclaimer_similarity,
+    'de': langcheck.metrics.de.ai_disclaimer_similarity,
+    'zh': langcheck.metrics.ai_disclaimer_similarity
+}
+
+# The model that langcheck computes the local factual consistency with, and
+# the models that it first translates the sources and responses in other
+# languages to English with
+FACTUAL_CONSISTENCY_MODEL = 'MingZhong/unieval-fact'
+FACTUAL_CONSISTENCY_TRANSLATION_MODELS = {
+    'ja': 'Helsinki-NLP/opus-mt-ja-en',
+    'de': 'Helsinki-NLP/opus-mt-de-en',
+    'zh': 'Helsinki-NLP/opus-mt-zh-en'
+}
+# The input that langcheck gives the model for each sentence of the response,
+# followed by the source, and the number of tokens that it truncates it to
+FACTUAL_CONSISTENCY_PROMPT = ('question: Is this claim consistent with the '
+                              'document? </s> claim: {claim} </s> document: ')
+FACTUAL_CONSISTENCY_MAX_TOKENS = 512
+# Tokens kept free in case the prompt, response and source tokenize slightly
+# differently once they are joined
+FACTUAL_CONSISTENCY_MARGIN_TOKENS = 8
+FACTUAL_CONSISTENCY_MIN_WINDOW_TOKENS = 64
+
+# Local model-based metrics that batch_metrics.py can compute for many chat
+# logs at once, along with the chat_log columns passed to the metric function
+BATCHABLE_LOCAL_METRICS = {
+    'request_toxicity': (TOXICITY_FNS, ['request']),
+    'response_toxicity': (TOXICITY_FNS, ['response']),
+    'request_sentiment': (SENTIMENT_FNS, ['request']),
+    'response_sentiment': (SENTIMENT_FNS, ['response']),
+    'request_fluency': (FLUENCY_FNS, ['request']),
+    'response_fluency': (FLUENCY_FNS, ['response']),
+    'ai_disclaimer_similarity': (AI_DISCLAIMER_SIMILARITY_FNS, ['response'])
+}
+
+# The OpenAI client used for LangCheck metrics in each process, keyed by the
+# process id so that a forked worker doesn't reuse its parent's connections
+_openai_clients: Dict[int, Tuple[str, Any, Dict[str, str]]] = {}
+_openai_clients_lock = threading.Lock()
+
+# The tokenizers that the windows of the sources are measured with (see
+# `split_source`)
+_tokenizers: Dict[str, Any] = {}
+_tokenizers_lock = threading.Lock()
+
+# The thread pool that computes metrics in each process, keyed by the process id
+# since a forked worker can't use its parent's threads
+_metric_executors: Dict[int, ThreadPoolExecutor] = {}
+_metric_executors_lock = threading.Lock()
+
+
+def get_langcheck_openai_client() -> Tuple[str, Any, Dict[str, str]]:
+    '''Returns the model type, client and `openai_args` to pass to the
+    OpenAI-based LangCheck metrics. The client is created once per process, so
+    all metrics and requests share its pool of keep-alive HTTP connections.
+    '''
+    pid = os.getpid()
+    with _openai_clients_lock:
+        if pid not in _openai_clients:
+            _openai_clients[pid] = _create_langcheck_openai_client()
+        return _openai_clients[pid]
+
+
+def _create_langcheck_openai_client() -> Tuple[str, Any, Dict[str, str]]:
+    assert os.environ['LANGCHECK_OPENAI_API_TYPE'] in ['openai', 'azure']
+    max_connections = int(
+        os.environ.get('LANGCHECK_OPENAI_MAX_CONNECTIONS', '20'))
+    timeout = float(os.environ.get('LANGCHECK_OPENAI_TIMEOUT_SECONDS', '60'))
+    max_retries = int(os.environ.get('LANGCHECK_OPENAI_MAX_RETRIES', '2'))
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_connections)
+    http_client = httpx.Client(limits=limits, timeout=timeout)
+    if os.environ['LANGCHECK_OPENAI_API_TYPE'] == 'azure':
+        model_type = 'azure_openai'
+        openai_client = AzureOpenAI(
+            api_key=os.environ['LANGCHECK_AZURE_OPENAI_KEY'],
+            api_version=os.environ['LANGCHECK_OPENAI_API_VERSION'],
+            azure_endpoint=os.environ['LANGCHECK_AZURE_OPENAI_ENDPOINT'],
+            http_client=http_client,
+            max_retries=max_retries,
+            timeout=timeout)
+        openai_args = {
+            'model': os.environ['LANGCHECK_AZURE_OPENAI_API_DEPLOYMENT']
+        }
+    else:
+        model_type = 'openai'
+        openai_client = OpenAI(api_key=os.environ['LANGCHECK_OPENAI_API_KEY'],
+                               http_client=http_client,
+                               max_retries=max_retries,
+                               timeout=timeout)
+        openai_args = {'model': os.environ['LANGCHECK_OPENAI_API_MODEL']}
+    return model_type, openai_client, openai_args
+
+
+def get_metric_executor() -> ThreadPoolExecutor:
+    '''Returns the thread pool that computes metrics in this process. It's
+    created once per process, so that its threads, and the db connection that
+    each thread keeps (see database.py), are reused by every metrics job.
+    '''
+    pid = os.getpid()
+    with _metric_executors_lock:
+        if pid not in _metric_executors:
+            max_concurrency = int(
+                os.environ.get('LANGCHECK_OPENAI_MAX_CONCURRENCY', '8'))
+            # One more thread for the local metrics
+            _metric_executors[pid] = ThreadPoolExecutor(
+                max_workers=max_concurrency + 1, thread_name_prefix='metric')
+        return _metric_executors[pid]
+
+
+def load_local_models(language) -> None:
+    '''Loads the local models of the language if this process hasn't loaded
+    them yet (i.e. the language isn't in METRIC_WORKER_WARMUP_LANGUAGES), so
+    that they are quantized like the models loaded at startup.
+    '''
+    # Imported here since model_registry imports this module
+    import model_registry
+    model_registry.load([language])
+
+
+def get_local_model_name(metric_fn, language) -> str:
+    '''Returns the model of a local metric in its metric cache keys, which
+    includes whether the model runs quantized so that the values computed in
+    int8 and float aren't mixed up.
+    '''
+    # Imported here since model_registry imports this module
+    import model_registry
+    inference_mode = model_registry.get_inference_mode(metric_fn, language)
+    if inference_mode is None:
+        return 'local'
+    return f'local-{inference_mode}'
+
 
 def add_init_to_db(request, response, source, language, score, explanation,
                    timestamp) -> int:
     if os.environ['ENABLE_LOCAL_LANGCHECK_MODELS'] == 'True':
-        log_id = db.insert_chatlog({
-            'request': request,
-            'response': response,
-            'source': source,
-            'language': language,
-            'timestamp': timestamp
-        })
-        db.insert_metric(log_id, 'factual_consistency', score, None)
+        factual_consistency_metric = ('factual_consistency', score, None)
     else:
-        log_id = db.insert_chatlog({
+        factual_consistency_metric = ('factual_consistency_openai', score,
+                                      explanation)
+    log_id = db.insert_chatlog(
+        {
             'request': request,
             'response': response,
             'source': source,
             'language': language,
             'timestamp': timestamp
-        })
-        db.insert_metric(log_id, 'factual_consistency_openai', score,
-                         explanation)
+        }, [factual_consistency_metric])
     # For type check
     assert log_id is not None
     return log_id
@@ -48,128 +212,360 @@ class Metric:
         self.compute_openai = compute_openai
         assert self.compute_local or self.compute_openai, \
             "At least one of compute_local and compute_openai must be True"
+        self.log_id = None
         self.local_metric_id = None
         self.openai_metric_id = None
 
-    def insert_metric_names_to_db(self, log_id, language):
+    def get_metric_names(self, language):
+        '''Returns the names of the metric rows to add to the database.
+        '''
+        if language not in self.metric_fns:
+            return []
+        metric_names = []
+        if self.compute_local:
+            metric_names.append(self.metric_name)
+        if self.compute_openai:
+            metric_names.append(f"{self.metric_name}_openai")
+        return metric_names
+
+    def set_metric_ids(self, log_id, metric_ids, language):
         if language not in self.metric_fns:
             return
+        self.log_id = log_id
         if self.compute_local:
-            self.local_metric_id = db.insert_metric(log_id, self.metric_name,
-                                                    None, None)
+            self.local_metric_id = metric_ids[self.metric_name]
         if self.compute_openai:
-            self.openai_metric_id = db.insert_metric(
-                log_id, f"{self.metric_name}_openai", None, None)
+            self.openai_metric_id = metric_ids[f"{self.metric_name}_openai"]
 
     def compute_local_metric(self, language):
         assert language in self.metric_fns
         metric_fn = self.metric_fns[language]
-        metric_result = metric_fn(*self.args)
-        return metric_result.metric_values[0]
+
+        def _compute():
+            metric_result = metric_fn(*self.args)
+            return metric_result.metric_values[0], None
+
+        with instrumentation.span('metric', self.metric_name, language):
+            # Load the models first, since whether they are quantized is part
+            # of the cache key
+            load_local_models(language)
+            model_name = get_local_model_name(metric_fn, language)
+            value, _ = metric_cache.get_or_compute(metric_fn, language,
+                                                   self.args, model_name,
+                                                   _compute)
+        return value
 
     def compute_openai_metric(self, language):
         assert language in self.metric_fns
         metric_fn = self.metric_fns[language]
-        assert os.environ['LANGCHECK_OPENAI_API_TYPE'] in ['openai', 'azure']
-        if os.environ['LANGCHECK_OPENAI_API_TYPE'] == 'azure':
-            model_type = 'azure_openai'
-            openai_client = AzureOpenAI(
-                api_key=os.environ['LANGCHECK_AZURE_OPENAI_KEY'],
-                api_version=os.environ['LANGCHECK_OPENAI_API_VERSION'],
-                azure_endpoint=os.environ['LANGCHECK_AZURE_OPENAI_ENDPOINT'])
-            openai_args = {
-                'model': os.environ['LANGCHECK_AZURE_OPENAI_API_DEPLOYMENT']
-            }
-        else:
-            model_type = 'openai'
-            openai_client = OpenAI(
-                api_key=os.environ['LANGCHECK_OPENAI_API_KEY'])
-            openai_args = {'model': os.environ['LANGCHECK_OPENAI_API_MODEL']}
-        metric_result = metric_fn(*self.args,
-                                  model_type=model_type,
-                                  openai_client=openai_client,
-                                  openai_args=openai_args)
-        return metric_result.metric_values[0], metric_result.explanations[0]
-
-    def compute_metrics_and_update_db(self, language):
-        if language not in self.metric_fns:
+        model_type, openai_client, openai_args = get_langcheck_openai_client()
+
+        def _compute():
+            metric_result = metric_fn(*self.args,
+                                      model_type=model_type,
+                                      openai_client=openai_client,
+                                      openai_args=openai_args)
+            explanation = metric_result.explanations[0]
+            return metric_result.metric_values[0], explanation
+
+        with instrumentation.span('metric', f'{self.metric_name}_openai',
+                                  language):
+            return metric_cache.get_or_compute(
+                metric_fn, language, self.args,
+                f"{model_type}:{openai_args['model']}", _compute)
+
+    def compute_openai_metric_and_update_db(self, language):
+        if language not in self.metric_fns or self.openai_metric_id is None:
             return
-        if self.local_metric_id is not None:
-            value = self.compute_local_metric(language)
-            db.update_metric_by_id(value, None, self.local_metric_id)
-        if self.openai_metric_id is not None:
-            value, explanation = self.compute_openai_metric(language)
-            db.update_metric_by_id(value, explanation, self.openai_metric_id)
+        try:
+            value, explanation = with_retry_backoff(self.compute_openai_metric,
+                                                    language)
+        except Exception:
+            # Store the metric without a value, like one that the API can't
+            # score, so that the chat log is still marked as done
+            print(f'Failed to compute {self.metric_name}_openai ({language}):',
+                  file=sys.stderr)
+            traceback.print_exc()
+            value, explanation = None, None
+        db.update_metric_by_id(value, explanation, self.openai_metric_id)
+        metric_events.publish_metric(self.log_id, f"{self.metric_name}_openai",
+                                     value, explanation)
+
+
+def with_retry_backoff(fn, *args):
+    '''Calls `fn`, which returns (metric value, explanation), retrying with
+    exponential backoff and jitter whenever it fails to compute the value.
+
+    LangCheck's OpenAI-based metrics catch the errors of the API (including
+    rate limits) and return None instead, so a None value is retried. The
+    OpenAI client also retries each request (see
+    `get_langcheck_openai_client`), so this only kicks in once those retries
+    are exhausted.
+    '''
+    max_attempts = int(os.environ.get('LANGCHECK_OPENAI_MAX_ATTEMPTS', '5'))
+    for attempt in range(max_attempts):
+        try:
+            value, explanation = fn(*args)
+        except RateLimitError:
+            if attempt == max_attempts - 1:
+                raise
+            value, explanation = None, None
+        if value is not None or attempt == max_attempts - 1:
+            return value, explanation
+        time.sleep(min(2**attempt, 30) * random.uniform(0.5, 1))
+
+
+def register_metrics(metrics: List[Metric], log_id, language) -> None:
+    '''Adds placeholder rows for the metrics to the database and sets the
+    status of the chat log to "pending" in a single transaction.
+    '''
+    metric_names = [
+        metric_name for metric in metrics
+        for metric_name in metric.get_metric_names(language)
+    ]
+    metric_ids = db.register_metrics(log_id, metric_names)
+    for metric in metrics:
+        metric.set_metric_ids(log_id, metric_ids, language)
+    metric_events.publish_status(log_id, 'pending')
+
+
+def compute_metrics_concurrently(
+    metrics: List[Metric], language, skip_local: Collection[str] = ()) -> None:
+    '''Computes the metrics and writes their values to the database as soon as
+    they are ready. The local versions of the metrics named in `skip_local` are
+    left for someone else (i.e. the batch worker) to compute.
+
+    The OpenAI metrics are network-bound, so they run concurrently on a bounded
+    thread pool. The local metrics are CPU-bound, so they run one after another
+    on a single thread alongside the OpenAI requests.
+
+    A metric that fails to be computed is stored without a value, so this only
+    raises if a value can't be written to the database.
+    '''
+
+    def _compute_local_metrics():
+        local_metrics = [
+            metric for metric in metrics if metric.local_metric_id is not None
+            and metric.metric_name not in skip_local
+        ]
+        values = []
+        for metric in local_metrics:
+            try:
+                values.append(metric.compute_local_metric(language))
+            except Exception:
+                # Store the metric without a value, so that one failing model
+                # doesn't discard the values of the others
+                print(f'Failed to compute {metric.metric_name} ({language}):',
+                      file=sys.stderr)
+                traceback.print_exc()
+                values.append(None)
+        # The local metrics are fast compared to the OpenAI ones, so they are
+        # written to the database together
+        db.update_metrics([(value, None, metric.local_metric_id)
+                           for metric, value in zip(local_metrics, values)])
+        for metric, value in zip(local_metrics, values):
+            metric_events.publish_metric(metric.log_id, metric.metric_name,
+                                         value, None)
+
+    executor = get_metric_executor()
+    # Run each metric in the context of the caller, so that its spans are
+    # included in the chat log's timings
+    futures = [
+        executor.submit(instrumentation.in_context(_compute_local_metrics))
+    ]
+    for metric in metrics:
+        compute = instrumentation.in_context(
+            metric.compute_openai_metric_and_update_db)
+        futures.append(executor.submit(compute, language))
+    # Let every metric finish before surfacing the first failure, so that one
+    # failing metric doesn't prevent the others from being stored
+    exceptions = [future.exception() for future in as_completed(futures)]
+    for exception in exceptions:
+        if exception is not None:
+            raise exception
+
+
+def mark_done_if_complete(log_id):
+    if db.mark_chatlog_done_if_complete(log_id):
+        metric_events.publish_status(log_id, 'done')
+
+
+def get_tokenizer(model_name) -> Any:
+    '''Returns the tokenizer of a Hugging Face model, which is loaded once per
+    process.
+    '''
+    with _tokenizers_lock:
+        if model_name not in _tokenizers:
+            _tokenizers[model_name] = AutoTokenizer.from_pretrained(model_name)
+        return _tokenizers[model_name]
+
+
+def get_source_tokenizer(language) -> Any:
+    model_name = FACTUAL_CONSISTENCY_TRANSLATION_MODELS.get(
+        language, FACTUAL_CONSISTENCY_MODEL)
+    return get_tokenizer(model_name)
+
+
+def _count_tokens(tokenizer, text) -> int:
+    return len(tokenizer(text, add_special_tokens=False)['input_ids'])
+
+
+def get_source_token_budget(response, language) -> int:
+    '''Returns the number of tokens of the source that fit in the input of
+    the local factual consistency model along with the response.
+
+    Sources in other languages than English are translated to English before
+    they are scored, so they are measured in the tokens of the translation
+    model, which are close to those of their translation.
+    '''
+    model_tokenizer = get_tokenizer(FACTUAL_CONSISTENCY_MODEL)
+    # The prompt with an empty response, including the special tokens
+    prompt = FACTUAL_CONSISTENCY_PROMPT.format(claim='')
+    prompt_tokens = len(model_tokenizer(prompt)['input_ids'])
+    # The whole response, although the model is only given one sentence of it
+    # at a time
+    response_tokens = _count_tokens(get_source_tokenizer(language), response)
+    budget = (FACTUAL_CONSISTENCY_MAX_TOKENS - prompt_tokens -
+              response_tokens - FACTUAL_CONSISTENCY_MARGIN_TOKENS)
+    # A response too long to leave room for the source is truncated anyway
+    return max(budget, FACTUAL_CONSISTENCY_MIN_WINDOW_TOKENS)
+
+
+def split_source(source, response, language) -> List[str]:
+    '''Splits the source into overlapping windows that each fit in the input
+    of the local factual consistency model along with the response (see
+    `get_source_token_budget`). Windows end on whitespace, or on any character
+    for Japanese and Chinese, which don't put spaces between words.
+    '''
+    tokenizer = get_source_tokenizer(language)
+    budget = get_source_token_budget(response, language)
+    if _count_tokens(tokenizer, source) <= budget:
+        return [source]
+
+    overlap = float(
+        os.environ.get('FACTUAL_CONSISTENCY_WINDOW_OVERLAP', '0.15'))
+    if language in ['ja', 'zh']:
+        spans = [(i, i + 1) for i in range(len(source)) if source[i].strip()]
+    else:
+        spans = [match.span() for match in re.finditer(r'\S+', source)]
+
+    def _fits(start, end):
+        window = source[spans[start][0]:spans[end - 1][1]]
+        return _count_tokens(tokenizer, window) <= budget
+
+    windows = []
+    start = 0
+    while True:
+        # Find the most spans from `start` that fit, assuming that a token
+        # doesn't cover more than 4 of them. A single span that doesn't fit is
+        # truncated by the model
+        low = start + 1
+        high = min(len(spans), start + 4 * budget)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if _fits(start, middle):
+                low = middle
+            else:
+                high = middle - 1
+        end = low
+        windows.append(source[spans[start][0]:spans[end - 1][1]])
+        if end == len(spans):
+            break
+        start += max(1, int((end - start) * (1 - overlap)))
+    return windows
+
+
+def compute_local_factual_consistency(responses, sources,
+                                      language) -> List[Optional[float]]:
+    '''Computes the local factual consistency of each response against its
+    source. Long sources are split into windows (see `split_source`), the
+    windows of all sources are scored with a single call to the model, and the
+    scores of each source's windows are aggregated with their max or mean
+    (FACTUAL_CONSISTENCY_AGGREGATION).
+    '''
+    load_local_models(language)
+    metric_fn = FACTUAL_CONSISTENCY_FNS[language]
+    aggregation = os.environ.get('FACTUAL_CONSISTENCY_AGGREGATION', 'max')
+    assert aggregation in ['max', 'mean']
+    windows = [
+        split_source(source, response, language)
+        for response, source in zip(responses, sources)
+    ]
+    window_responses = [
+        response for response, source_windows in zip(responses, windows)
+        for _ in source_windows
+    ]
+    window_sources = [
+        window for source_windows in windows for window in source_windows
+    ]
+    window_values = iter(
+        metric_fn(window_responses, window_sources).metric_values)
+
+    values = []
+    for source_windows in windows:
+        scores = [next(window_values) for _ in source_windows]
+        scores = [score for score in scores if score is not None]
+        if not scores:
+            values.append(None)
+        elif aggregation == 'max':
+            values.append(max(scores))
+        else:
+            values.append(sum(scores) / len(scores))
+    return values
 
 
 def get_factual_consistency(response, source,
                             language) -> Tuple[float, Optional[str]]:
     use_local = os.environ['ENABLE_LOCAL_LANGCHECK_MODELS'] == 'True'
+    with instrumentation.span('factual_consistency',
+                              'local' if use_local else 'openai', language):
+        return _get_factual_consistency(response, source, language, use_local)
 
-    if language == 'ja' and use_local:
-        # TODO: Remove this once the problem is fixed in langcheck package
-        if len(source) >= 512:
-            first_factual_consistency_metric = Metric(
-                'factual_consistency', {
-                    'en': langcheck.metrics.factual_consistency,
-                    'ja': langcheck.metrics.ja.factual_consistency,
-                    'de': langcheck.metrics.de.factual_consistency,
-                    'zh': langcheck.metrics.zh.factual_consistency
-                }, [response, source[:len(source) // 2]], True, False)
-            second_factual_consistency_metric = Metric(
-                'factual_consistency', {
-                    'en': langcheck.metrics.factual_consistency,
-                    'ja': langcheck.metrics.ja.factual_consistency,
-                    'de': langcheck.metrics.de.factual_consistency,
-                    'zh': langcheck.metrics.zh.factual_consistency
-                }, [response, source[len(source) // 2:]], True, False)
-            first_score = first_factual_consistency_metric.compute_local_metric(
-                language)
-            second_score = second_factual_consistency_metric.compute_local_metric(
-                language)
-            return max(first_score, second_score), None
 
+def _get_factual_consistency(response, source, language,
+                             use_local) -> Tuple[float, Optional[str]]:
     if use_local:
-        factual_consistency_metric = Metric(
-            'factual_consistency', {
-                'en': langcheck.metrics.factual_consistency,
-                'ja': langcheck.metrics.ja.factual_consistency,
-                'de': langcheck.metrics.de.factual_consistency,
-                'zh': langcheck.metrics.zh.factual_consistency
-            }, [response, source], True, False)
-        return factual_consistency_metric.compute_local_metric(language), None
+        aggregation = os.environ.get('FACTUAL_CONSISTENCY_AGGREGATION', 'max')
+        metric_fn = FACTUAL_CONSISTENCY_FNS[language]
+        load_local_models(language)
+        windows = split_source(source, response, language)
+        model_name = get_local_model_name(metric_fn, language)
+
+        def _compute():
+            values = compute_local_factual_consistency([response], [source],
+                                                       language)
+            return values[0], None
+
+        return metric_cache.get_or_compute(metric_fn, language,
+                                           [response, windows],
+                                           f'{model_name}:{aggregation}',
+                                           _compute)
 
     else:
-        factual_consistency_metric = Metric(
-            'factual_consistency', {
-                'en': langcheck.metrics.factual_consistency,
-                'ja': langcheck.metrics.ja.factual_consistency,
-                'de': langcheck.metrics.de.factual_consistency,
-                'zh': langcheck.metrics.zh.factual_consistency
-            }, [response, source], False, True)
+        factual_consistency_metric = Metric('factual_consistency',
+                                            FACTUAL_CONSISTENCY_FNS,
+                                            [response, source], False, True)
         return factual_consistency_metric.compute_openai_metric(language)
 
 
-def main(log_id):
-    chatlog = db.get_chatlog_by_id(log_id)
-    request = chatlog['request']
-    response = chatlog['response']
-    source = chatlog['source']
-    language = chatlog['language']
-
+def build_metrics(request,
+                  response,
+                  source,
+                  enable_local,
+                  include_factual_consistency=False) -> List[Metric]:
+    '''Returns the metrics to compute for a chat log. The factual consistency
+    score is normally computed while answering the question, so it's only
+    included if `include_factual_consistency` is True (e.g. when re-scoring
+    logs from the command line).
+    '''
     metrics_to_compute = []
-    enable_local = os.environ['ENABLE_LOCAL_LANGCHECK_MODELS'] == 'True'
-    if enable_local:
-        # If the local version of factual consistency was computed first, we
-        # need to now compute the OpenAI version
+    # If the local version of factual consistency was computed first, we need
+    # to now compute the OpenAI version
+    local_factual_consistency = include_factual_consistency and enable_local
+    if include_factual_consistency or enable_local:
         metrics_to_compute.append(
-            Metric(
-                'factual_consistency', {
-                    'en': langcheck.metrics.factual_consistency,
-                    'ja': langcheck.metrics.ja.factual_consistency,
-                    'de': langcheck.metrics.de.factual_consistency,
-                    'zh': langcheck.metrics.zh.factual_consistency
-                }, [response, source], False, True))
+            Metric('factual_consistency', FACTUAL_CONSISTENCY_FNS,
+                   [response, source], local_factual_consistency, True))
     metrics_to_compute.append(
         Metric(
             'context_relevance', {
@@ -185,51 +581,22 @@ def main(log_id):
                 'de': langcheck.metrics.de.answer_relevance
             }, [response, request], False, True))
     metrics_to_compute.append(
-        Metric(
-            'request_toxicity', {
-                'en': langcheck.metrics.toxicity,
-                'ja': langcheck.metrics.ja.toxicity,
-                'de': langcheck.metrics.de.toxicity,
-                'zh': langcheck.metrics.zh.toxicity
-            }, [request], enable_local, True))
+        Metric('request_toxicity', TOXICITY_FNS, [request], enable_local,
+               True))
     metrics_to_compute.append(
-        Metric(
-            'response_toxicity', {
-                'en': langcheck.metrics.toxicity,
-                'ja': langcheck.metrics.ja.toxicity,
-                'de': langcheck.metrics.de.toxicity,
-                'zh': langcheck.metrics.zh.toxicity
-            }, [response], enable_local, True))
+        Metric('response_toxicity', TOXICITY_FNS, [response], enable_local,
+               True))
     metrics_to_compute.append(
-        Metric(
-            'request_sentiment', {
-                'en': langcheck.metrics.sentiment,
-                'ja': langcheck.metrics.ja.sentiment,
-                'de': langcheck.metrics.de.sentiment,
-                'zh': langcheck.metrics.zh.sentiment
-            }, [request], enable_local, True))
+        Metric('request_sentiment', SENTIMENT_FNS, [request], enable_local,
+               True))
     metrics_to_compute.append(
-        Metric(
-            'response_sentiment', {
-                'en': langcheck.metrics.sentiment,
-                'ja': langcheck.metrics.ja.sentiment,
-                'de': langcheck.metrics.de.sentiment,
-                'zh': langcheck.metrics.zh.sentiment
-            }, [response], enable_local, True))
+        Metric('response_sentiment', SENTIMENT_FNS, [response], enable_local,
+               True))
     metrics_to_compute.append(
-        Metric(
-            'request_fluency', {
-                'en': langcheck.metrics.fluency,
-                'ja': langcheck.metrics.ja.fluency,
-                'de': langcheck.metrics.de.fluency
-            }, [request], enable_local, True))
+        Metric('request_fluency', FLUENCY_FNS, [request], enable_local, True))
     metrics_to_compute.append(
-        Metric(
-            'response_fluency', {
-                'en': langcheck.metrics.fluency,
-                'ja': langcheck.metrics.ja.fluency,
-                'de': langcheck.metrics.de.fluency
-            }, [response], enable_local, True))
+        Metric('response_fluency', FLUENCY_FNS, [response], enable_local,
+               True))
     metrics_to_compute.append(
         Metric(
             'request_readability', {
@@ -246,26 +613,44 @@ def main(log_id):
                 'de': langcheck.metrics.de.flesch_reading_ease,
                 'zh': langcheck.metrics.zh.xuyaochen_report_readability
             }, [response], True, False))
-    # TODO: Use japanese and chinese metrics once implemented
     metrics_to_compute.append(
-        Metric(
-            'ai_disclaimer_similarity', {
-                'en': langcheck.metrics.ai_disclaimer_similarity,
-                'ja': langcheck.metrics.ai_disclaimer_similarity,
-                'de': langcheck.metrics.de.ai_disclaimer_similarity,
-                'zh': langcheck.metrics.ai_disclaimer_similarity
-            }, [response], True, False))
+        Metric('ai_disclaimer_similarity', AI_DISCLAIMER_SIMILARITY_FNS,
+               [response], True, False))
+
+    return metrics_to_compute
+
+
+def main(log_id):
+    with instrumentation.trace() as timings:
+        _compute_metrics(log_id)
+    instrumentation.save_log_timings(log_id, timings)
+
+
+def _compute_metrics(log_id):
+    chatlog = db.get_chatlog_by_id(log_id)
+    request = chatlog['request']
+    response = chatlog['response']
+    source = chatlog['source']
+    language = chatlog['language']
+
+    enable_local = os.environ['ENABLE_LOCAL_LANGCHECK_MODELS'] == 'True'
+    metrics_to_compute = build_metrics(request, response, source, enable_local)
 
     # First, add the metric names to the database, but don't yet compute the
     # metrics
-    for metric in metrics_to_compute:
-        metric.insert_metric_names_to_db(log_id, language)
-    db.update_chatlog_by_id({'status': 'pending'}, log_id)
+    register_metrics(metrics_to_compute, log_id, language)
 
     # Then, compute the metrics and update the database
-    for metric in metrics_to_compute:
-        metric.compute_metrics_and_update_db(language)
-    db.update_chatlog_by_id({'status': 'done'}, log_id)
+    skip_local: Collection[str] = ()
+    if os.environ.get('METRIC_BATCH_MODE', 'False') == 'True':
+        # The batch worker computes the local model-based metrics of many logs
+        # at once, so whoever writes the last value marks the log as done
+        skip_local = BATCHABLE_LOCAL_METRICS.keys()
+    try:
+        compute_metrics_concurrently(metrics_to_compute, language, skip_local)
+    finally:
+        # The log stays pending only if a value couldn't be written
+        mark_done_if_complete(log_id)
 
 
 if __name__ == '__main__':
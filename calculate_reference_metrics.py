@@ -1,19 +1,16 @@
 import sys
+from typing import List
 
 import langcheck.metrics
 
 import database as db
-from calculate_metrics import Metric
+import instrumentation
+from calculate_metrics import (Metric, compute_metrics_concurrently,
+                               mark_done_if_complete, register_metrics)
 
 
-def main(log_id, reference):
-    chatlog = db.get_chatlog_by_id(log_id)
-    request = chatlog['request']
-    response = chatlog['response']
-    language = chatlog['language']
-    db.update_chatlog_by_id({'status': 'new', 'reference': reference}, log_id)
-
-    metrics_to_compute = [
+def build_reference_metrics(request, response, reference) -> List[Metric]:
+    return [
         Metric(
             'rouge1', {
                 'en': langcheck.metrics.rouge1,
@@ -44,16 +41,31 @@ def main(log_id, reference):
             }, [response, reference, request], True, False)
     ]
 
+
+def main(log_id, reference):
+    with instrumentation.trace() as timings:
+        _compute_reference_metrics(log_id, reference)
+    instrumentation.save_log_timings(log_id, timings)
+
+
+def _compute_reference_metrics(log_id, reference):
+    chatlog = db.get_chatlog_by_id(log_id)
+    request = chatlog['request']
+    response = chatlog['response']
+    language = chatlog['language']
+    db.update_chatlog_by_id({'status': 'new', 'reference': reference}, log_id)
+
+    metrics_to_compute = build_reference_metrics(request, response, reference)
+
     # First, add the metric names to the database, but don't yet compute the
     # metrics
-    for metric in metrics_to_compute:
-        metric.insert_metric_names_to_db(log_id, language)
-    db.update_chatlog_by_id({'status': 'pending'}, log_id)
+    register_metrics(metrics_to_compute, log_id, language)
 
     # Then, compute the metrics and update the database
-    for metric in metrics_to_compute:
-        metric.compute_metrics_and_update_db(language)
-    db.update_chatlog_by_id({'status': 'done'}, log_id)
+    try:
+        compute_metrics_concurrently(metrics_to_compute, language)
+    finally:
+        mark_done_if_complete(log_id)
 
 
 if __name__ == '__main__':
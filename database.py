@@ -1,7 +1,28 @@
+import os
 import sqlite3
-from typing import Any, Dict, List, Optional
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import instrumentation
 
 DATABASE_URL = 'db/langcheckchat.db'
+MIGRATIONS_DIR = 'db/migrations'
+
+# How long a query waits for another process to release its lock on the
+# database before failing with "database is locked"
+BUSY_TIMEOUT_MS = 10000
+
+# Maximum number of prepared statements kept per connection
+CACHED_STATEMENTS = 256
+
+# Number of metric rollup histogram buckets per unit of metric value (must
+# match db/migrations/002_add_metric_rollups.sql)
+ROLLUP_BUCKETS_PER_UNIT = 10
+
+# Each thread of each process reuses its own connection
+_local = threading.local()
 
 
 def initialize_db():
@@ -9,12 +30,72 @@ def initialize_db():
         chat_log_schema_script = file.read()
     with open('db/metric_schema.sql', 'r') as file:
         metric_schema_script = file.read()
+    with open('db/metric_cache_schema.sql', 'r') as file:
+        metric_cache_schema_script = file.read()
 
     with sqlite3.connect(DATABASE_URL) as conn:
         cursor = conn.cursor()
         cursor.executescript(chat_log_schema_script)
         cursor.executescript(metric_schema_script)
+        cursor.executescript(metric_cache_schema_script)
         conn.commit()
+        _apply_migrations(conn)
+
+
+def _apply_migrations(conn: sqlite3.Connection) -> None:
+    '''Applies the scripts in db/migrations that haven't been applied yet, in
+    the order of their file names. The number of applied scripts is stored in
+    the user_version of the database.
+    '''
+    num_applied = conn.execute('PRAGMA user_version').fetchone()[0]
+    migrations = sorted(file_name for file_name in os.listdir(MIGRATIONS_DIR)
+                        if file_name.endswith('.sql'))
+    for version, file_name in enumerate(migrations[num_applied:],
+                                        start=num_applied + 1):
+        with open(os.path.join(MIGRATIONS_DIR, file_name), 'r') as file:
+            migration_script = file.read()
+        conn.executescript(f'''
+            BEGIN;
+            {migration_script};
+            PRAGMA user_version = {version};
+            COMMIT;
+        ''')
+
+
+def _get_connection() -> sqlite3.Connection:
+    '''Returns the connection of the current thread, opening it on first use.
+
+    The database uses WAL journaling, so that readers don't block the metric
+    workers writing to it (and vice versa), and writers wait for each other
+    instead of failing. Connections aren't shared across a fork.
+    '''
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(DATABASE_URL,
+                               timeout=BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        # With WAL, NORMAL only syncs at checkpoints and is still safe from
+        # corruption
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+        # Use up to 20MB of page cache per connection
+        conn.execute('PRAGMA cache_size = -20000')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+@contextmanager
+def _transaction() -> Iterator[sqlite3.Connection]:
+    '''Runs the queries in the block in a single transaction, which is
+    committed at the end of the block or rolled back on an error.
+    '''
+    conn = _get_connection()
+    with conn:
+        yield conn
 
 
 def _select_data(query: str,
@@ -24,10 +105,8 @@ def _select_data(query: str,
     if params is None:
         params = {}
 
-    with sqlite3.connect(DATABASE_URL) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        return cursor.execute(query, params).fetchall()
+    conn = _get_connection()
+    return conn.execute(query, params).fetchall()
 
 
 def _edit_data(query: str,
@@ -38,13 +117,14 @@ def _edit_data(query: str,
     if params is None:
         params = []
 
-    with sqlite3.connect(DATABASE_URL) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(query, params)
+    conn = _get_connection()
+    # Commits the transaction, or rolls it back on an error
+    with conn:
+        cursor = conn.execute(query, params)
         return cursor.lastrowid
 
 
+@instrumentation.timed('db')
 def get_chatlog_by_id(id: int) -> Dict[str, Any]:
     query = '''
         SELECT * FROM chat_log
@@ -56,10 +136,17 @@ def get_chatlog_by_id(id: int) -> Dict[str, Any]:
     return {}
 
 
-def get_chatlogs_and_metrics(limit: int, offset: int) -> List[dict]:
+@instrumentation.timed('db')
+def get_chatlogs_and_metrics(
+        limit: int,
+        offset: int = 0,
+        before: Optional[Tuple[str, int]] = None) -> List[dict]:
     '''
-    Returns a list of chat logs and metrics, each of which is a dictionary with
-    the following structure:
+    Returns a list of chat logs and metrics, newest first. If `before` is given
+    as a (timestamp, id) pair, only the chat logs older than it are returned,
+    which, unlike `offset`, stays fast for pages deep into the history.
+
+    Each chat log is a dictionary with the following structure:
     {
         "<chat_log_id>": {
             "id": <chat_log_id>,
@@ -78,16 +165,23 @@ def get_chatlogs_and_metrics(limit: int, offset: int) -> List[dict]:
         }
     }
     '''
-    query = '''
+    params: Dict[str, Any] = {'limit': limit, 'offset': offset}
+    where_clause = ''
+    if before is not None:
+        where_clause = 'WHERE (timestamp, id) < (:before_timestamp, :before_id)'
+        params['before_timestamp'], params['before_id'] = before
+    query = f'''
         SELECT chat_log.*, metric.metric_name, metric.metric_value, metric.explanation
         FROM (
             SELECT * FROM chat_log
-            ORDER BY timestamp DESC
+            {where_clause}
+            ORDER BY timestamp DESC, id DESC
             LIMIT :limit OFFSET :offset
         ) AS chat_log
         LEFT JOIN metric ON chat_log.id = metric.log_id
+        ORDER BY chat_log.timestamp DESC, chat_log.id DESC
     '''
-    all_logs = _select_data(query, {'limit': limit, 'offset': offset})
+    all_logs = _select_data(query, params)
     metric_columns = ['metric_name', 'metric_value', 'explanation']
 
     # Each row in all_logs corresponds to a single metric. We want to group
@@ -109,26 +203,122 @@ def get_chatlogs_and_metrics(limit: int, offset: int) -> List[dict]:
     return list(id_to_logs.values())
 
 
-def insert_chatlog(data: Dict[str, Any]) -> int:
+@instrumentation.timed('db')
+def insert_chatlog(
+    data: Dict[str, Any],
+    metrics: Optional[List[Tuple[str, Optional[float], Optional[str]]]] = None
+) -> int:
+    '''Inserts a chat log, along with its already computed metrics given as
+    (metric name, metric value, explanation), in a single transaction.
+    '''
     columns = ', '.join(data.keys())
     placeholders = ', '.join(['?' for _ in data.keys()])
     query = f'''
         INSERT INTO chat_log ({columns}) VALUES ({placeholders})
     '''
-    id = _edit_data(query, list(data.values()))
-    assert id is not None
+    metric_query = '''
+        INSERT INTO metric (log_id, metric_name, metric_value, explanation)
+        VALUES (?, ?, ?, ?)
+    '''
+    with _transaction() as conn:
+        id = conn.execute(query, list(data.values())).lastrowid
+        assert id is not None
+        conn.executemany(
+            metric_query,
+            [(id, metric_name, metric_value, explanation)
+             for metric_name, metric_value, explanation in metrics or []])
+        _update_rollups(conn, 'metric.log_id = ?', [id], 1)
     return id
 
 
+@instrumentation.timed('db')
+def insert_chatlogs(data: List[Dict[str, Any]]) -> List[int]:
+    '''Inserts many chat logs with the same columns in a single transaction
+    and returns their ids.
+    '''
+    columns = ', '.join(data[0].keys())
+    placeholders = ', '.join(['?' for _ in data[0].keys()])
+    query = f'''
+        INSERT INTO chat_log ({columns}) VALUES ({placeholders})
+    '''
+    with _transaction() as conn:
+        return [
+            conn.execute(query, list(row.values())).lastrowid for row in data
+        ]
+
+
+@instrumentation.timed('db')
+def get_chatlog_ids(start_id: Optional[int] = None,
+                    end_id: Optional[int] = None,
+                    language: Optional[str] = None,
+                    status: Optional[str] = None,
+                    since: Optional[str] = None,
+                    until: Optional[str] = None) -> List[int]:
+    '''Returns the ids of the chat logs that match all of the given filters,
+    in ascending order. `start_id`, `end_id`, `since` and `until` are
+    inclusive.
+    '''
+    conditions = []
+    params: Dict[str, Any] = {}
+    if start_id is not None:
+        conditions.append('id >= :start_id')
+        params['start_id'] = start_id
+    if end_id is not None:
+        conditions.append('id <= :end_id')
+        params['end_id'] = end_id
+    if language is not None:
+        conditions.append('language = :language')
+        params['language'] = language
+    if status is not None:
+        conditions.append('status = :status')
+        params['status'] = status
+    if since is not None:
+        conditions.append('timestamp >= :since')
+        params['since'] = since
+    if until is not None:
+        conditions.append('substr(timestamp, 1, length(:until)) <= :until')
+        params['until'] = until
+    where_clause = ' AND '.join(conditions) or '1'
+    query = f'''
+        SELECT id FROM chat_log
+        WHERE {where_clause}
+        ORDER BY id
+    '''
+    return [row['id'] for row in _select_data(query, params)]
+
+
+@instrumentation.timed('db')
+def get_chatlogs_by_ids(ids: List[int]) -> List[Dict[str, Any]]:
+    placeholders = ', '.join(['?' for _ in ids])
+    query = f'''
+        SELECT * FROM chat_log
+        WHERE id IN ({placeholders})
+        ORDER BY id
+    '''
+    return [dict(row) for row in _get_connection().execute(query, ids)]
+
+
+@instrumentation.timed('db')
+def update_chatlog_status_by_ids(ids: List[int], status: str) -> None:
+    query = '''
+        UPDATE chat_log SET status = ? WHERE id = ?
+    '''
+    with _transaction() as conn:
+        conn.executemany(query, [(status, id) for id in ids])
+    return
+
+
+@instrumentation.timed('db')
 def update_chatlog_by_id(data: Dict[str, Any], id) -> None:
     set_clause = ', '.join([f"{key} = ?" for key in data.keys()])
     query = f'''
-        UPDATE chat_log SET {set_clause} WHERE id = {id}
+        UPDATE chat_log SET {set_clause} WHERE id = ?
     '''
-    _edit_data(query, list(data.values()))
+    _edit_data(query, list(data.values()) + [id])
     return
 
 
+@instrumentation.timed('db')
 def insert_metric(log_id: int, metric_name: str, metric_value: Optional[float],
                   explanation: Optional[str]) -> int:
     col_names = ['log_id', 'metric_name', 'metric_value', 'explanation']
@@ -142,16 +332,222 @@ def insert_metric(log_id: int, metric_name: str, metric_value: Optional[float],
     return id
 
 
+# Not timed, since `update_metrics` is
 def update_metric_by_id(metric_value: float, explanation: Optional[str],
                         id: int) -> None:
-    set_clause = ', '.join(['metric_value = ?', 'explanation = ?'])
-    query = f'''
-        UPDATE metric SET {set_clause} WHERE id = {id}
+    update_metrics([(metric_value, explanation, id)])
+    return
+
+
+@instrumentation.timed('db')
+def register_metrics(log_id: int, metric_names: List[str]) -> Dict[str, int]:
+    '''Inserts placeholder rows for the metrics of the chat log and sets its
+    status to "pending" in a single transaction, so that readers never see a
+    partially registered set of metrics. Returns the ids of the rows by metric
+    name.
+    '''
+    # If the metric was already computed before (e.g. for a previous reference
+    # answer), reset it instead
+    insert_query = '''
+        INSERT INTO metric (log_id, metric_name, computed) VALUES (?, ?, 0)
+        ON CONFLICT (log_id, metric_name)
+        DO UPDATE SET metric_value = NULL, explanation = NULL, computed = 0
+    '''
+    status_query = '''
+        UPDATE chat_log SET status = 'pending' WHERE id = ?
+    '''
+    select_query = '''
+        SELECT id, metric_name FROM metric
+        WHERE log_id = ?
+    '''
+    with _transaction() as conn:
+        # Remove the values that are about to be reset from the rollups
+        _update_rollups(conn, 'metric.log_id = ?', [log_id], -1)
+        conn.executemany(insert_query, [(log_id, metric_name)
+                                        for metric_name in metric_names])
+        _update_rollups(conn, 'metric.log_id = ?', [log_id], 1)
+        conn.execute(status_query, [log_id])
+        metrics = conn.execute(select_query, [log_id]).fetchall()
+    return {metric['metric_name']: metric['id'] for metric in metrics}
+
+
+@instrumentation.timed('db')
+def update_metrics(
+        values: List[Tuple[Optional[float], Optional[str], int]]) -> None:
+    '''Updates many metrics, given as (metric value, explanation, id), in a
+    single transaction, and marks them as computed even if their value is None.
+    '''
+    query = '''
+        UPDATE metric SET metric_value = ?, explanation = ?, computed = 1
+        WHERE id = ?
     '''
-    _edit_data(query, [metric_value, explanation])
+    with _transaction() as conn:
+        # Keep each chunk's list of ids under SQLite's limit on the number of
+        # query parameters
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            ids = [id for _, _, id in chunk]
+            id_placeholders = ', '.join(['?' for _ in ids])
+            where_clause = f'metric.id IN ({id_placeholders})'
+            _update_rollups(conn, where_clause, ids, -1)
+            conn.executemany(query, chunk)
+            _update_rollups(conn, where_clause, ids, 1)
     return
 
 
+def _update_rollups(conn: sqlite3.Connection, where_clause: str,
+                    params: List[Any], sign: int) -> None:
+    '''Adds (if `sign` is 1) or removes (if `sign` is -1) the values of the
+    metrics matching `where_clause` to or from the hourly rollups. Removing a
+    value doesn't update the min and max.
+    '''
+    bucket = (f'CAST(metric.metric_value * {ROLLUP_BUCKETS_PER_UNIT} '
+              'AS INTEGER)')
+    bucket = (f'{bucket} - (metric.metric_value * {ROLLUP_BUCKETS_PER_UNIT} '
+              f'< {bucket})')
+    conn.execute(
+        f'''
+        INSERT INTO metric_rollup
+        SELECT metric.metric_name, chat_log.language,
+            substr(chat_log.timestamp, 1, 13), {sign} * COUNT(*),
+            {sign} * SUM(metric.metric_value), MIN(metric.metric_value),
+            MAX(metric.metric_value)
+        FROM metric
+        JOIN chat_log ON metric.log_id = chat_log.id
+        WHERE {where_clause} AND metric.metric_value IS NOT NULL
+        GROUP BY 1, 2, 3
+        ON CONFLICT (metric_name, language, hour) DO UPDATE SET
+            count = count + excluded.count,
+            sum = sum + excluded.sum,
+            min = min(min, excluded.min),
+            max = max(max, excluded.max)
+    ''', params)
+    conn.execute(
+        f'''
+        INSERT INTO metric_rollup_histogram
+        SELECT metric.metric_name, chat_log.language,
+            substr(chat_log.timestamp, 1, 13), {bucket}, {sign} * COUNT(*)
+        FROM metric
+        JOIN chat_log ON metric.log_id = chat_log.id
+        WHERE {where_clause} AND metric.metric_value IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (metric_name, language, hour, bucket) DO UPDATE SET
+            count = count + excluded.count
+    ''', params)
+
+
+@instrumentation.timed('db')
+def get_metric_summary(metric_name: Optional[str] = None,
+                       language: Optional[str] = None,
+                       start: Optional[str] = None,
+                       end: Optional[str] = None,
+                       granularity: str = 'hour') -> List[Dict[str, Any]]:
+    '''Returns the count, mean, min, max and histogram of the metric values
+    per metric, language and hour (or day), computed from the rollups. `start`
+    and `end` are inclusive timestamps (e.g. "2024-01-31" or
+    "2024-01-31 09").
+    '''
+    assert granularity in ['hour', 'day']
+    period_length = 13 if granularity == 'hour' else 10
+    conditions = []
+    params: Dict[str, Any] = {}
+    if metric_name is not None:
+        conditions.append('metric_name = :metric_name')
+        params['metric_name'] = metric_name
+    if language is not None:
+        conditions.append('language = :language')
+        params['language'] = language
+    if start is not None:
+        conditions.append('hour >= substr(:start, 1, 13)')
+        params['start'] = start
+    if end is not None:
+        conditions.append('substr(hour, 1, length(:end)) <= :end')
+        params['end'] = end
+    where_clause = ' AND '.join(conditions) or '1'
+
+    summary_query = f'''
+        SELECT metric_name, language, substr(hour, 1, {period_length}) AS period,
+            SUM(count) AS count, SUM(sum) AS sum, MIN(min) AS min,
+            MAX(max) AS max
+        FROM metric_rollup
+        WHERE {where_clause}
+        GROUP BY 1, 2, 3
+        HAVING SUM(count) > 0
+        ORDER BY 1, 2, 3
+    '''
+    histogram_query = f'''
+        SELECT metric_name, language, substr(hour, 1, {period_length}) AS period,
+            bucket, SUM(count) AS count
+        FROM metric_rollup_histogram
+        WHERE {where_clause}
+        GROUP BY 1, 2, 3, 4
+        HAVING SUM(count) > 0
+    '''
+    histograms: Dict[Tuple[str, str, str], Dict[str, int]] = {}
+    for row in _select_data(histogram_query, params):
+        key = (row['metric_name'], row['language'], row['period'])
+        bucket_start = row['bucket'] / ROLLUP_BUCKETS_PER_UNIT
+        histograms.setdefault(key, {})[str(bucket_start)] = row['count']
+
+    summary = []
+    for row in _select_data(summary_query, params):
+        key = (row['metric_name'], row['language'], row['period'])
+        summary.append({
+            'metric_name': row['metric_name'],
+            'language': row['language'],
+            'period': row['period'],
+            'count': row['count'],
+            'mean': row['sum'] / row['count'],
+            'min': row['min'],
+            'max': row['max'],
+            'histogram': histograms.get(key, {})
+        })
+    return summary
+
+
+@instrumentation.timed('db')
+def get_pending_metrics(metric_names: List[str]) -> List[Dict[str, Any]]:
+    '''Returns the metrics with the given names that have not been computed
+    yet for chat logs in the "pending" status, along with the chat log columns
+    needed to compute them.
+    '''
+    params = {f'name{i}': name for i, name in enumerate(metric_names)}
+    placeholders = ', '.join([f':{key}' for key in params])
+    query = f'''
+        SELECT metric.id, metric.log_id, metric.metric_name, chat_log.request,
+            chat_log.response, chat_log.reference, chat_log.source,
+            chat_log.language
+        FROM metric
+        JOIN chat_log ON metric.log_id = chat_log.id
+        WHERE metric.computed = 0
+            AND chat_log.status = 'pending'
+            AND metric.metric_name IN ({placeholders})
+        ORDER BY metric.id
+    '''
+    return [dict(row) for row in _select_data(query, params)]
+
+
+@instrumentation.timed('db')
+def mark_chatlog_done_if_complete(log_id: int) -> bool:
+    '''Sets the status of the chat log to "done" if all of its metrics have
+    been computed (or failed to be), and returns whether the chat log is done.
+    '''
+    query = '''
+        UPDATE chat_log SET status = 'done'
+        WHERE id = ? AND NOT EXISTS (
+            SELECT 1 FROM metric
+            WHERE log_id = ? AND computed = 0
+        )
+    '''
+    _edit_data(query, [log_id, log_id])
+    # Read with `_select_data` rather than `get_chatlog_by_id`, so that the
+    # time isn't counted twice
+    chat_logs = _select_data('SELECT status FROM chat_log WHERE id = :id',
+                             {'id': log_id})
+    return len(chat_logs) == 1 and chat_logs[0]['status'] == 'done'
+
+
+@instrumentation.timed('db')
 def get_metrics_by_log_id(log_id: int) -> Dict[str, Dict[str, Any]]:
     query = '''
         SELECT * FROM metric
@@ -165,3 +561,240 @@ def get_metrics_by_log_id(log_id: int) -> Dict[str, Dict[str, Any]]:
         }
         for metric in metrics
     }
+
+
+@instrumentation.timed('db')
+def get_cached_metric(
+        cache_key: str,
+        min_created_at: float) -> Optional[Tuple[float, Optional[str]]]:
+    '''Returns the cached metric value and explanation for the key, or None if
+    there is no entry newer than `min_created_at`. The access time of the entry
+    is updated later, along with others (see `update_metric_cache_stats`).
+    '''
+    query = '''
+        SELECT metric_value, explanation FROM metric_cache
+        WHERE cache_key = :cache_key AND created_at >= :min_created_at
+    '''
+    entries = _select_data(query, {
+        'cache_key': cache_key,
+        'min_created_at': min_created_at
+    })
+    if len(entries) == 0:
+        return None
+    return entries[0]['metric_value'], entries[0]['explanation']
+
+
+@instrumentation.timed('db')
+def insert_cached_metric(cache_key: str, metric_value: float,
+                         explanation: Optional[str]) -> None:
+    now = time.time()
+    query = '''
+        INSERT OR REPLACE INTO metric_cache
+            (cache_key, metric_value, explanation, created_at, last_accessed)
+        VALUES (?, ?, ?, ?, ?)
+    '''
+    _edit_data(query, [cache_key, metric_value, explanation, now, now])
+    return
+
+
+@instrumentation.timed('db')
+def evict_cached_metrics(min_created_at: float, max_entries: int) -> None:
+    '''Deletes the cache entries older than `min_created_at`, and then the
+    least recently used entries beyond `max_entries`.
+    '''
+    _edit_data('DELETE FROM metric_cache WHERE created_at < ?',
+               [min_created_at])
+    query = '''
+        DELETE FROM metric_cache WHERE cache_key IN (
+            SELECT cache_key FROM metric_cache
+            ORDER BY last_accessed DESC
+            LIMIT -1 OFFSET ?
+        )
+    '''
+    _edit_data(query, [max_entries])
+    return
+
+
+@instrumentation.timed('db')
+def update_metric_cache_stats(counts: Dict[str, int],
+                              accesses: Dict[str, float]) -> None:
+    '''Adds to the hit/miss counters and sets the last access time of cache
+    entries, given by their key, in a single transaction.
+    '''
+    stats_query = '''
+        INSERT INTO metric_cache_stats (name, count) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET count = count + excluded.count
+    '''
+    access_query = '''
+        UPDATE metric_cache SET last_accessed = max(last_accessed, ?)
+        WHERE cache_key = ?
+    '''
+    with _transaction() as conn:
+        conn.executemany(stats_query, list(counts.items()))
+        conn.executemany(access_query,
+                         [(last_accessed, cache_key)
+                          for cache_key, last_accessed in accesses.items()])
+    return
+
+
+@instrumentation.timed('db')
+def get_metric_cache_stats() -> Dict[str, int]:
+    stats = {
+        row['name']: row['count']
+        for row in _select_data('SELECT * FROM metric_cache_stats')
+    }
+    entries = _select_data('SELECT COUNT(*) AS count FROM metric_cache')
+    stats['entries'] = entries[0]['count']
+    return stats
+
+
+@instrumentation.timed('db')
+def get_cached_answers(index_version: str,
+                       min_created_at: float) -> List[Dict[str, Any]]:
+    '''Returns the cached answers generated from the index version that are
+    newer than `min_created_at`.
+    '''
+    query = '''
+        SELECT * FROM answer_cache
+        WHERE index_version = :index_version
+            AND created_at >= :min_created_at
+    '''
+    cached_answers = _select_data(query, {
+        'index_version': index_version,
+        'min_created_at': min_created_at
+    })
+    return [dict(cached_answer) for cached_answer in cached_answers]
+
+
+@instrumentation.timed('db')
+def insert_cached_answer(question: str, language: str, embedding: bytes,
+                         response: str, source: str,
+                         index_version: str) -> int:
+    now = time.time()
+    query = '''
+        INSERT INTO answer_cache
+            (question, language, embedding, response, source, index_version,
+             created_at, last_accessed)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    id = _edit_data(query, [
+        question, language, embedding, response, source, index_version, now,
+        now
+    ])
+    # For type check
+    assert id is not None
+    return id
+
+
+@instrumentation.timed('db')
+def update_cached_answer_access(id: int) -> None:
+    query = '''
+        UPDATE answer_cache SET last_accessed = ? WHERE id = ?
+    '''
+    _edit_data(query, [time.time(), id])
+    return
+
+
+@instrumentation.timed('db')
+def evict_cached_answers(index_version: str, min_created_at: float,
+                         max_entries: int) -> None:
+    '''Deletes the cached answers generated from other index versions or
+    older than `min_created_at`, and then the least recently used answers
+    beyond `max_entries`.
+    '''
+    _edit_data(
+        'DELETE FROM answer_cache WHERE index_version != ? OR created_at < ?',
+        [index_version, min_created_at])
+    query = '''
+        DELETE FROM answer_cache WHERE id IN (
+            SELECT id FROM answer_cache
+            ORDER BY last_accessed DESC
+            LIMIT -1 OFFSET ?
+        )
+    '''
+    _edit_data(query, [max_entries])
+    return
+
+
+# The histogram of the durations of a stage as (stage, name, language, count,
+# sum, [(bucket upper bound, count)])
+StageTiming = Tuple[str, str, str, int, float, List[Tuple[float, int]]]
+
+
+def add_stage_timings(stage_timings: List[StageTiming]) -> None:
+    '''Adds the histograms of the durations of stages to the totals in a single
+    transaction. Unlike the other queries, the queries on timings aren't timed
+    themselves, since they run when a process saves its timings.
+    '''
+    query = '''
+        INSERT INTO stage_timing (stage, name, language, count, sum)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (stage, name, language) DO UPDATE SET
+            count = count + excluded.count,
+            sum = sum + excluded.sum
+    '''
+    histogram_query = '''
+        INSERT INTO stage_timing_histogram (stage, name, language, le, count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (stage, name, language, le) DO UPDATE SET
+            count = count + excluded.count
+    '''
+    with _transaction() as conn:
+        conn.executemany(
+            query, [(stage, name, language, count, sum)
+                    for stage, name, language, count, sum, _ in stage_timings])
+        conn.executemany(
+            histogram_query,
+            [(stage, name, language, le, bucket_count)
+             for stage, name, language, _, _, buckets in stage_timings
+             for le, bucket_count in buckets if bucket_count > 0])
+    return
+
+
+def get_stage_timings() -> List[Dict[str, Any]]:
+    '''Returns the count, sum and bucket counts (keyed by the upper bound of
+    the bucket) of the durations of each stage, name and language.
+    '''
+    query = '''
+        SELECT * FROM stage_timing
+        ORDER BY stage, name, language
+    '''
+    stage_timings = {}
+    for row in _select_data(query):
+        stage_timing = dict(row)
+        stage_timing['buckets'] = {}
+        stage_timings[(row['stage'], row['name'],
+                       row['language'])] = stage_timing
+    for row in _select_data('SELECT * FROM stage_timing_histogram'):
+        key = (row['stage'], row['name'], row['language'])
+        if key in stage_timings:
+            stage_timings[key]['buckets'][row['le']] = row['count']
+    return list(stage_timings.values())
+
+
+def add_log_timings(log_id: int, timings: List[Tuple[str, str, int,
+                                                     float]]) -> None:
+    '''Adds the (stage, name, count, seconds) of the spans of a chat log to
+    its timings.
+    '''
+    query = '''
+        INSERT INTO chat_log_timing (log_id, stage, name, count, seconds)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (log_id, stage, name) DO UPDATE SET
+            count = count + excluded.count,
+            seconds = seconds + excluded.seconds
+    '''
+    with _transaction() as conn:
+        conn.executemany(query, [(log_id, stage, name, count, seconds)
+                                 for stage, name, count, seconds in timings])
+    return
+
+
+def get_log_timings(log_id: int) -> List[Dict[str, Any]]:
+    query = '''
+        SELECT stage, name, count, seconds FROM chat_log_timing
+        WHERE log_id = :log_id
+        ORDER BY seconds DESC
+    '''
+    timings = _select_data(query, {'log_id': log_id})
+    return [dict(timing) for timing in timings]
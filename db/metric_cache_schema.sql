@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS metric_cache (
+    cache_key TEXT PRIMARY KEY,  /* hash of the metric, language, inputs and model */
+    metric_value REAL NOT NULL,
+    explanation TEXT,
+    created_at REAL NOT NULL,
+    last_accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metric_cache_last_accessed
+    ON metric_cache (last_accessed);
+CREATE TABLE IF NOT EXISTS metric_cache_stats (
+    name TEXT PRIMARY KEY,  /* hits, misses */
+    count INTEGER NOT NULL DEFAULT 0
+);
\ No newline at end of file
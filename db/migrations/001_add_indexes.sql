@@ -0,0 +1,10 @@
+/* Re-submitting a reference answer used to add a second set of reference-based
+metrics to a chat log, so keep only the latest row of each metric before
+making (log_id, metric_name) unique */
+DELETE FROM metric WHERE id NOT IN (
+    SELECT MAX(id) FROM metric GROUP BY log_id, metric_name
+);
+CREATE UNIQUE INDEX IF NOT EXISTS metric_log_id_metric_name
+    ON metric (log_id, metric_name);
+CREATE INDEX IF NOT EXISTS chat_log_timestamp_id
+    ON chat_log (timestamp DESC, id DESC);
\ No newline at end of file
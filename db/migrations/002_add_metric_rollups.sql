@@ -0,0 +1,39 @@
+/* Hourly summaries of the metric values per language, which are updated
+whenever a metric value is written (see _update_rollups in database.py) */
+CREATE TABLE IF NOT EXISTS metric_rollup (
+    metric_name TEXT NOT NULL,
+    language TEXT NOT NULL,
+    hour TEXT NOT NULL,  /* YYYY-MM-DD HH */
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (metric_name, language, hour)
+);
+CREATE TABLE IF NOT EXISTS metric_rollup_histogram (
+    metric_name TEXT NOT NULL,
+    language TEXT NOT NULL,
+    hour TEXT NOT NULL,
+    bucket INTEGER NOT NULL,  /* floor(metric_value * 10), i.e. buckets of width 0.1 */
+    count INTEGER NOT NULL,
+    PRIMARY KEY (metric_name, language, hour, bucket)
+);
+
+/* Summarize the metrics computed before this migration */
+INSERT INTO metric_rollup
+SELECT metric.metric_name, chat_log.language, substr(chat_log.timestamp, 1, 13),
+    COUNT(*), SUM(metric.metric_value), MIN(metric.metric_value),
+    MAX(metric.metric_value)
+FROM metric
+JOIN chat_log ON metric.log_id = chat_log.id
+WHERE metric.metric_value IS NOT NULL
+GROUP BY 1, 2, 3;
+INSERT INTO metric_rollup_histogram
+SELECT metric.metric_name, chat_log.language, substr(chat_log.timestamp, 1, 13),
+    CAST(metric.metric_value * 10 AS INTEGER)
+        - (metric.metric_value * 10 < CAST(metric.metric_value * 10 AS INTEGER)),
+    COUNT(*)
+FROM metric
+JOIN chat_log ON metric.log_id = chat_log.id
+WHERE metric.metric_value IS NOT NULL
+GROUP BY 1, 2, 3, 4;
\ No newline at end of file
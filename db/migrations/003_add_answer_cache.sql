@@ -0,0 +1,15 @@
+/* Answers generated by the RAG system, which are looked up by the embedding of
+their question (see answer_cache.py) */
+CREATE TABLE IF NOT EXISTS answer_cache (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    question TEXT NOT NULL,
+    language TEXT NOT NULL,
+    embedding BLOB NOT NULL,  /* normalized float32 vector */
+    response TEXT NOT NULL,
+    source TEXT NOT NULL,
+    index_version TEXT NOT NULL,  /* hash of the documents and models that generated the answer */
+    created_at REAL NOT NULL,
+    last_accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answer_cache_index_version
+    ON answer_cache (index_version, created_at);
\ No newline at end of file
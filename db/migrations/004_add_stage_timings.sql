@@ -0,0 +1,31 @@
+/* Histograms of the time spent in each stage of answering questions and
+computing metrics, summed over all processes (see instrumentation.py). Each
+bucket counts the durations up to its upper bound `le` (in seconds) that are
+above the previous bucket's bound */
+CREATE TABLE IF NOT EXISTS stage_timing (
+    stage TEXT NOT NULL,  /* e.g. rag, factual_consistency, metric, db */
+    name TEXT NOT NULL,  /* e.g. the step, metric or db function */
+    language TEXT NOT NULL,  /* empty if the stage doesn't depend on it */
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    PRIMARY KEY (stage, name, language)
+);
+CREATE TABLE IF NOT EXISTS stage_timing_histogram (
+    stage TEXT NOT NULL,
+    name TEXT NOT NULL,
+    language TEXT NOT NULL,
+    le REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (stage, name, language, le)
+);
+
+/* The time spent in each stage for each chat log, if INSTRUMENTATION_LOG_TIMINGS
+is 'True' */
+CREATE TABLE IF NOT EXISTS chat_log_timing (
+    log_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (log_id, stage, name)
+);
\ No newline at end of file
@@ -0,0 +1,8 @@
+/* Whether each metric has been computed, since a metric that couldn't be
+computed (e.g. the OpenAI API didn't return a valid score) keeps a NULL value.
+Metrics are inserted as computed unless they are placeholders (see
+register_metrics in database.py) */
+ALTER TABLE metric ADD COLUMN computed INTEGER NOT NULL DEFAULT 1;
+UPDATE metric SET computed = 0
+WHERE metric_value IS NULL
+    AND log_id IN (SELECT id FROM chat_log WHERE status = 'pending');
\ No newline at end of file
@@ -0,0 +1,263 @@
+'''Computes the LangCheck metrics of many chat logs from the command line, e.g.
+to re-score the history after a model change or to evaluate a dataset of Q&A
+pairs.
+
+Examples:
+    # Re-score all Japanese chat logs from January 2024
+    python evaluate.py --language ja --since 2024-01-01 --until 2024-01-31
+
+    # Import a JSONL or CSV file of Q&A pairs and score them
+    python evaluate.py --input dataset.jsonl
+
+If the run is interrupted, running the same command again resumes it from the
+checkpoint file.
+'''
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+import pytz
+from dotenv import load_dotenv
+
+import database as db
+from calculate_metrics import (Metric, build_metrics,
+                               compute_local_factual_consistency,
+                               load_local_models, register_metrics,
+                               with_retry_backoff)
+from calculate_reference_metrics import build_reference_metrics
+
+load_dotenv()
+
+
+def import_dataset(path: str, default_language: str) -> List[int]:
+    '''Adds the Q&A pairs in a JSONL or CSV file to the chat logs and returns
+    their ids. Each row needs "request", "response" and "source" fields, and
+    may have "language", "reference" and "timestamp" fields.
+    '''
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    timestamp = datetime.now(
+        pytz.timezone('Asia/Tokyo')).strftime('%Y-%m-%d %H:%M:%S')
+    return db.insert_chatlogs([{
+        'request': row['request'],
+        'response': row['response'],
+        'source': row['source'],
+        'language': row.get('language') or default_language,
+        'reference': row.get('reference') or None,
+        'timestamp': row.get('timestamp') or timestamp
+    } for row in rows])
+
+
+def evaluate_batch(log_ids: List[int]) -> Tuple[List[int], List[int]]:
+    '''Computes all metrics of the chat logs, including factual consistency and
+    the reference-based metrics if a log has a reference, and writes the values
+    back in a single transaction.
+
+    Each local metric is computed for all of the logs in one call, and the
+    OpenAI metrics are computed concurrently. Returns the ids of the logs and
+    the ids of the logs with metrics that failed, which stay "pending".
+    '''
+    enable_local = os.environ['ENABLE_LOCAL_LANGCHECK_MODELS'] == 'True'
+    local_metrics: Dict[Tuple[str, str], List[Metric]] = defaultdict(list)
+    openai_metrics: List[Tuple[Metric, str]] = []
+    for chatlog in db.get_chatlogs_by_ids(log_ids):
+        language = chatlog['language']
+        metrics = build_metrics(chatlog['request'],
+                                chatlog['response'],
+                                chatlog['source'],
+                                enable_local,
+                                include_factual_consistency=True)
+        if chatlog['reference']:
+            metrics += build_reference_metrics(chatlog['request'],
+                                               chatlog['response'],
+                                               chatlog['reference'])
+        register_metrics(metrics, chatlog['id'], language)
+        for metric in metrics:
+            if metric.local_metric_id is not None:
+                local_metrics[(metric.metric_name, language)].append(metric)
+            if metric.openai_metric_id is not None:
+                openai_metrics.append((metric, language))
+
+    values: List[Tuple[Optional[float], Optional[str], int]] = []
+    failed_log_ids: Set[int] = set()
+    for (metric_name, language), metrics in local_metrics.items():
+        try:
+            values += _compute_local_batch(metric_name, language, metrics)
+        except Exception:
+            print(f'Failed to compute {metric_name} ({language}):',
+                  file=sys.stderr)
+            traceback.print_exc()
+            failed_log_ids.update(metric.log_id for metric in metrics)
+
+    def _compute_openai_metric(metric: Metric, language: str):
+        value, explanation = with_retry_backoff(metric.compute_openai_metric,
+                                                language)
+        return value, explanation, metric.openai_metric_id
+
+    max_concurrency = int(
+        os.environ.get('LANGCHECK_OPENAI_MAX_CONCURRENCY', '8'))
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {
+            executor.submit(_compute_openai_metric, metric, language): metric
+            for metric, language in openai_metrics
+        }
+        for future in as_completed(futures):
+            metric = futures[future]
+            if future.exception() is not None:
+                metric_name = f'{metric.metric_name}_openai'
+                print(
+                    f'Failed to compute {metric_name} for log '
+                    f'{metric.log_id}: {future.exception()!r}',
+                    file=sys.stderr)
+                failed_log_ids.add(metric.log_id)
+            else:
+                values.append(future.result())
+
+    db.update_metrics(values)
+    done_log_ids = [id for id in log_ids if id not in failed_log_ids]
+    db.update_chatlog_status_by_ids(done_log_ids, 'done')
+    return log_ids, sorted(failed_log_ids)
+
+
+def _compute_local_batch(
+        metric_name: str, language: str,
+        metrics: List[Metric]) -> List[Tuple[Optional[float], None, int]]:
+    if metric_name == 'factual_consistency':
+        # Long sources need to be split into windows that fit in the model
+        responses, sources = zip(*(metric.args for metric in metrics))
+        metric_values = compute_local_factual_consistency(
+            responses, sources, language)
+    else:
+        load_local_models(language)
+        metric_fn = metrics[0].metric_fns[language]
+        args = [list(arg) for arg in zip(*(metric.args for metric in metrics))]
+        metric_values = metric_fn(*args).metric_values
+    return [(value, None, metric.local_metric_id)
+            for metric, value in zip(metrics, metric_values)]
+
+
+def _load_checkpoint(path: str) -> Optional[Tuple[List[int], Set[int]]]:
+    '''Returns the ids of all logs in the run and of the logs already evaluated.
+
+    The first line of the checkpoint file has the ids of all logs, and each
+    following line has the ids of a batch of evaluated logs.
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    done = {id for batch in lines[1:] for id in batch}
+    return lines[0], done
+
+
+def _format_duration(seconds: float) -> str:
+    return str(timedelta(seconds=int(seconds)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compute the LangCheck metrics of many chat logs.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__)
+    parser.add_argument('--input',
+                        help='JSONL or CSV file of Q&A pairs to import and '
+                        'evaluate, instead of existing chat logs')
+    parser.add_argument('--start-id', type=int, help='Smallest chat log id')
+    parser.add_argument('--end-id', type=int, help='Largest chat log id')
+    parser.add_argument('--language',
+                        help='Only evaluate chat logs in this language (also '
+                        'the default language of imported rows)')
+    parser.add_argument('--status',
+                        help='Only evaluate chat logs with this status')
+    parser.add_argument('--since',
+                        help='Earliest timestamp, e.g. "2024-01-31"')
+    parser.add_argument('--until',
+                        help='Latest timestamp (inclusive), e.g. "2024-01-31"')
+    parser.add_argument('--processes',
+                        type=int,
+                        default=2,
+                        help='Number of worker processes')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=64,
+                        help='Number of chat logs per batch')
+    parser.add_argument('--checkpoint',
+                        default='evaluate_checkpoint.jsonl',
+                        help='File that records the progress of the run')
+    parser.add_argument('--restart',
+                        action='store_true',
+                        help='Ignore an existing checkpoint file')
+    args = parser.parse_args()
+
+    db.initialize_db()
+    checkpoint = None if args.restart else _load_checkpoint(args.checkpoint)
+    if checkpoint is not None:
+        log_ids, done = checkpoint
+        print(
+            f'Resuming from {args.checkpoint}: {len(done)} of '
+            f'{len(log_ids)} chat logs already evaluated',
+            file=sys.stderr)
+    else:
+        if args.input is not None:
+            log_ids = import_dataset(args.input, args.language or 'en')
+        else:
+            log_ids = db.get_chatlog_ids(args.start_id, args.end_id,
+                                         args.language, args.status,
+                                         args.since, args.until)
+        done = set()
+        with open(args.checkpoint, 'w') as f:
+            f.write(json.dumps(log_ids) + '\n')
+
+    remaining = [id for id in log_ids if id not in done]
+    batches = [
+        remaining[i:i + args.batch_size]
+        for i in range(0, len(remaining), args.batch_size)
+    ]
+    num_done = len(done)
+    num_evaluated = 0
+    all_failed_log_ids = []
+    start = time.perf_counter()
+    # Fork so that the workers inherit the imported langcheck modules
+    context = multiprocessing.get_context('fork')
+    with open(args.checkpoint, 'a') as checkpoint_file:
+        with context.Pool(args.processes) as pool:
+            for batch, failed_log_ids in pool.imap_unordered(
+                    evaluate_batch, batches):
+                checkpoint_file.write(json.dumps(batch) + '\n')
+                checkpoint_file.flush()
+                all_failed_log_ids += failed_log_ids
+
+                num_done += len(batch)
+                num_evaluated += len(batch)
+                rate = num_evaluated / (time.perf_counter() - start)
+                eta = (len(log_ids) - num_done) / rate
+                progress = (f'{num_done}/{len(log_ids)} chat logs | '
+                            f'{rate:.2f} rows/s | '
+                            f'ETA {_format_duration(eta)}')
+                print(f'\r{progress}', end='', file=sys.stderr)
+    print(file=sys.stderr)
+
+    os.remove(args.checkpoint)
+    print(f'Evaluated {len(log_ids)} chat logs', file=sys.stderr)
+    if all_failed_log_ids:
+        num_failed = len(all_failed_log_ids)
+        print(
+            f'{num_failed} chat logs have metrics that failed and are still '
+            '"pending", run again with --status pending to retry',
+            file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
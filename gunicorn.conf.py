@@ -0,0 +1,33 @@
+# Configuration for running the app with gunicorn:
+#     gunicorn app:app
+import os
+
+bind = '127.0.0.1:5000'
+workers = int(os.environ.get('GUNICORN_WORKERS', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+# Streaming responses (chat tokens and metric updates) stay open for a while
+timeout = 120
+
+# Import the app (which loads the RAG index and the local LangCheck models) once
+# in the master process, so that the workers share the loaded models through
+# copy-on-write memory after they are forked instead of each loading them
+preload_app = True
+
+# A pool of metric worker processes can't be shared across a fork, so each
+# gunicorn worker starts its own after it is forked
+os.environ['METRIC_WORKER_START_AFTER_FORK'] = 'True'
+
+
+def on_starting(server):
+    import database as db
+    db.initialize_db()
+
+
+def post_fork(server, worker):
+    import metric_worker
+    metric_worker.start()
+    # The OpenAI clients of the RAG system were created by the master process
+    # (and may hold connections opened while indexing), so each worker creates
+    # its own
+    from api_routes import rag_system
+    rag_system.reset_clients()
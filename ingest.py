@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import html2text
+from dotenv import load_dotenv
+from llama_index.core import Document
+from llama_index.readers.file import MarkdownReader
+from llama_index.readers.web import SimpleWebPageReader
+
+# The parsed text and the hash of the raw content of each source
+SAVED_DOCUMENTS = 'documents.json'
+
+DEFAULT_SOURCES = [
+    "https://langcheck.readthedocs.io/en/latest/langcheck.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.en.reference_based_text_quality.html",
+    "https://langcheck.readthedocs.io/en/latest/installation.html",
+    "https://langcheck.readthedocs.io/en/latest/metrics.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.utils.io.html",
+    "https://langcheck.readthedocs.io/en/latest/index.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.ja.reference_free_text_quality.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.ja.html",
+    "https://langcheck.readthedocs.io/en/latest/py-modindex.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.metric_value.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.text_structure.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.plot.html",
+    "https://langcheck.readthedocs.io/en/latest/genindex.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.en.source_based_text_quality.html",
+    "https://langcheck.readthedocs.io/en/latest/contributing.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.en.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.reference_based_text_quality.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.ja.reference_based_text_quality.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.utils.html",
+    "https://langcheck.readthedocs.io/en/latest/langcheck.metrics.en.reference_free_text_quality.html",
+    "https://langcheck.readthedocs.io/en/latest/quickstart.html",
+]
+
+# File types that are read from local directories
+LOCAL_FILE_SUFFIXES = ['.md', '.txt', '.html', '.htm']
+
+load_dotenv()
+
+
+def get_sources() -> List[str]:
+    '''Returns the URLs and local files to build the index from. Local
+    directories in RAG_DOCUMENT_SOURCES are expanded to the files in them.
+    '''
+    sources = [
+        source.strip()
+        for source in os.environ.get('RAG_DOCUMENT_SOURCES', '').split(',')
+        if source.strip()
+    ] or DEFAULT_SOURCES
+    expanded_sources = []
+    for source in sources:
+        if not _is_url(source) and os.path.isdir(source):
+            expanded_sources += sorted(
+                str(path) for path in Path(source).rglob('*')
+                if path.suffix in LOCAL_FILE_SUFFIXES)
+        else:
+            expanded_sources.append(source)
+    return expanded_sources
+
+
+def load_documents(
+        refresh: bool = False,
+        sources_to_refresh: Optional[List[str]] = None) -> List[Document]:
+    '''Returns a document for each source, whose id is the URL or file path of
+    the source.
+
+    Sources that were fetched by a previous run are read from SAVED_DOCUMENTS,
+    so only new sources are fetched, unless `refresh` is True (which fetches
+    all sources again) or the source is in `sources_to_refresh`. Fetched
+    sources are only parsed again if their content has changed.
+    '''
+    saved_documents: Dict[str, Dict[str, str]] = {}
+    if os.path.exists(SAVED_DOCUMENTS):
+        with open(SAVED_DOCUMENTS, 'r') as f:
+            saved_documents = json.load(f)
+
+    sources = get_sources()
+    sources_to_refresh = sources_to_refresh or []
+    to_fetch = [
+        source for source in sources if refresh
+        or source not in saved_documents or source in sources_to_refresh
+    ]
+    max_workers = int(os.environ.get('RAG_INGEST_MAX_WORKERS', '8'))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        contents = list(executor.map(_fetch, to_fetch))
+
+    num_parsed = 0
+    for source, content in zip(to_fetch, contents):
+        content_hash = hashlib.sha256(content.encode()).hexdigest()
+        saved_hash = saved_documents.get(source, {}).get('hash')
+        if saved_hash == content_hash:
+            continue
+        saved_documents[source] = {
+            'hash': content_hash,
+            'text': _markdown_to_text(content)
+        }
+        num_parsed += 1
+
+    # Forget the sources that were removed from the configuration
+    saved_documents = {source: saved_documents[source] for source in sources}
+    if to_fetch:
+        with open(SAVED_DOCUMENTS, 'w') as f:
+            json.dump(saved_documents, f, ensure_ascii=False)
+        num_fetched = len(to_fetch)
+        print(
+            f'Fetched {num_fetched} and parsed {num_parsed} of '
+            f'{len(sources)} documents',
+            file=sys.stderr)
+
+    return [
+        Document(text=saved_documents[source]['text'], id_=source)
+        for source in sources
+    ]
+
+
+def _is_url(source: str) -> bool:
+    return source.startswith('http://') or source.startswith('https://')
+
+
+def _fetch(source: str) -> str:
+    '''Returns the content of the source as markdown.
+    '''
+    if _is_url(source):
+        loader = SimpleWebPageReader(html_to_text=True)
+        return loader.load_data(urls=[source])[0].text
+
+    with open(source, 'r', encoding='utf-8') as f:
+        content = f.read()
+    if Path(source).suffix in ['.html', '.htm']:
+        return html2text.html2text(content)
+    return content
+
+
+def _markdown_to_text(markdown: str) -> str:
+    '''Parses the markdown the same way as `MarkdownReader.load_data`, without
+    writing it to a file first.
+    '''
+    markdown_reader = MarkdownReader()
+    markdown = markdown_reader.remove_hyperlinks(markdown)
+    markdown = markdown_reader.remove_images(markdown)
+    texts = [
+        value if header is None else f'\n\n{header}\n{value}'
+        for header, value in markdown_reader.markdown_to_tups(markdown)
+    ]
+    return '\n'.join(texts)
+
+
+if __name__ == '__main__':
+    # Fetches the given sources (or all sources) again and updates the index
+    # with the documents that have changed
+    from rag import RAG
+    if len(sys.argv) > 1:
+        RAG(sources_to_refresh=sys.argv[1:])
+    else:
+        RAG(refresh_documents=True)
@@ -0,0 +1,231 @@
+'''Measures the time spent in each stage of answering a question and computing
+its metrics: retrieval and synthesis in the RAG system, the factual consistency
+score, each metric and each db query.
+
+The durations are aggregated into histograms by stage, name and language in
+each process, which are added to the db every few seconds, so that /metrics can
+report the histograms of all gunicorn and metric worker processes in the
+Prometheus text format. If INSTRUMENTATION_LOG_TIMINGS is 'True', the time spent
+in each stage is also saved for each chat log.
+'''
+import atexit
+import bisect
+import contextvars
+import functools
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Upper bounds of the histogram buckets in seconds, from fast db queries to
+# slow LLM calls
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+           5.0, 10.0, 30.0, 60.0)
+
+# Minimum number of seconds between two writes of a process's histograms to the
+# db, unless forced
+FLUSH_INTERVAL_SECONDS = 5
+
+PROMETHEUS_METRIC_NAME = 'langcheckchat_stage_duration_seconds'
+
+# A span's (stage, name, duration in seconds)
+Timing = Tuple[str, str, float]
+
+
+class _Histogram:
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        # The number of durations in each bucket, excluding the durations above
+        # the largest bound
+        self.bucket_counts = [0] * len(BUCKETS)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.sum += seconds
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        if bucket < len(BUCKETS):
+            self.bucket_counts[bucket] += 1
+
+
+# The histograms of this process that haven't been added to the db yet, keyed
+# by (stage, name, language)
+_histograms: Dict[Tuple[str, str, str], _Histogram] = {}
+_histograms_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+# The spans of the chat log being processed in the current context (see
+# `trace`)
+_timings: 'contextvars.ContextVar[Optional[List[Timing]]]' = (
+    contextvars.ContextVar('timings', default=None))
+
+
+def _reset_after_fork() -> None:
+    '''Drops the histograms that a forked process inherits, since the parent
+    process adds them to the db itself.
+    '''
+    global _histograms, _histograms_lock, _last_flush
+    _histograms = {}
+    _histograms_lock = threading.Lock()
+    _last_flush = time.monotonic()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _is_enabled() -> bool:
+    return os.environ.get('INSTRUMENTATION_ENABLED', 'True') == 'True'
+
+
+def record(stage: str, name: str, language: str, seconds: float) -> None:
+    with _histograms_lock:
+        key = (stage, name, language)
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram()
+        histogram.observe(seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((stage, name, seconds))
+
+
+@contextmanager
+def span(stage: str, name: str = '', language: str = '') -> Iterator[None]:
+    '''Times the block, including when it raises an error.
+    '''
+    if not _is_enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, name, language, time.perf_counter() - start)
+
+
+def timed(stage: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    '''Decorates a function to time each call in a span named after the
+    function.
+    '''
+
+    def decorator(fn: Callable[..., Any]) -> Callable[..., Any]:
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage, fn.__name__):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def trace(timings: Optional[List[Timing]] = None) -> Iterator[List[Timing]]:
+    '''Collects the spans in the block into `timings` (a new list by default).
+    Functions submitted to a thread pool in the block are only traced if they
+    are wrapped with `in_context`.
+    '''
+    if timings is None:
+        timings = []
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def in_context(fn: Callable[..., Any]) -> Callable[..., Any]:
+    '''Returns `fn` bound to a copy of the current context, so that its spans
+    are collected by the current `trace` when it runs on another thread.
+    '''
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def save_log_timings(log_id: int, timings: List[Timing]) -> None:
+    '''Adds the total time spent in each stage to the timings of the chat log,
+    if INSTRUMENTATION_LOG_TIMINGS is 'True'.
+    '''
+    if (os.environ.get('INSTRUMENTATION_LOG_TIMINGS', 'False') != 'True'
+            or not timings):
+        return
+    totals: Dict[Tuple[str, str], Tuple[int, float]] = {}
+    for stage, name, seconds in timings:
+        count, total = totals.get((stage, name), (0, 0.0))
+        totals[(stage, name)] = count + 1, total + seconds
+    log_timings = [(stage, name, count, total)
+                   for (stage, name), (count, total) in totals.items()]
+    # Imported here since database.py times its queries with this module
+    import database as db
+    db.add_log_timings(log_id, log_timings)
+
+
+def flush(force: bool = False) -> None:
+    '''Adds the histograms of this process to the db, at most every
+    FLUSH_INTERVAL_SECONDS unless `force` is True.
+    '''
+    global _histograms, _last_flush
+    with _histograms_lock:
+        due = (force
+               or time.monotonic() - _last_flush >= FLUSH_INTERVAL_SECONDS)
+        if not _histograms or not due:
+            return
+        histograms = _histograms
+        _histograms = {}
+        _last_flush = time.monotonic()
+
+    stage_timings = []
+    for (stage, name, language), histogram in histograms.items():
+        buckets = list(zip(BUCKETS, histogram.bucket_counts))
+        stage_timings.append(
+            (stage, name, language, histogram.count, histogram.sum, buckets))
+    # Imported here since database.py times its queries with this module
+    import database as db
+    try:
+        db.add_stage_timings(stage_timings)
+    except Exception:
+        # Losing some timings is better than failing the chat or metric job
+        print('Failed to save the stage timings:', file=sys.stderr)
+        traceback.print_exc()
+
+
+atexit.register(flush, force=True)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus() -> str:
+    '''Returns the histograms of all processes in the Prometheus text format.
+    '''
+    flush(force=True)
+    # Imported here since database.py times its queries with this module
+    import database as db
+    lines = [
+        f'# HELP {PROMETHEUS_METRIC_NAME} Time spent in each stage of '
+        'answering questions and computing metrics.',
+        f'# TYPE {PROMETHEUS_METRIC_NAME} histogram'
+    ]
+    for stage_timing in db.get_stage_timings():
+        labels = ','.join(f'{label}="{_escape_label(stage_timing[label])}"'
+                          for label in ['stage', 'name', 'language'])
+        name = PROMETHEUS_METRIC_NAME
+        cumulative_count = 0
+        for le in BUCKETS:
+            cumulative_count += stage_timing['buckets'].get(le, 0)
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} '
+                         f'{cumulative_count}')
+        count = stage_timing['count']
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f"{name}_sum{{{labels}}} {stage_timing['sum']}")
+        lines.append(f'{name}_count{{{labels}}} {count}')
+    return '\n'.join(lines) + '\n'
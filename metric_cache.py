@@ -0,0 +1,150 @@
+import atexit
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+import database as db
+
+load_dotenv()
+
+# Number of cache insertions between evictions of expired and excess entries
+EVICTION_INTERVAL = 100
+
+# Minimum number of seconds between two writes of a process's hit/miss counts
+# and access times to the db, unless forced
+FLUSH_INTERVAL_SECONDS = 5
+
+_num_inserts = 0
+
+# The hit/miss counts and the last access time of each cache entry in this
+# process that haven't been written to the db yet, so that a lookup doesn't
+# need a write transaction
+_pending_counts: Dict[str, int] = {}
+_pending_accesses: Dict[str, float] = {}
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def _reset_after_fork() -> None:
+    '''Drops the counts that a forked process inherits, since the parent
+    process writes them to the db itself.
+    '''
+    global _pending_counts, _pending_accesses, _pending_lock, _last_flush
+    _pending_counts = {}
+    _pending_accesses = {}
+    _pending_lock = threading.Lock()
+    _last_flush = time.monotonic()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _is_enabled() -> bool:
+    return os.environ.get('METRIC_CACHE_ENABLED', 'True') == 'True'
+
+
+def _cache_key(metric_fn: Callable[..., Any], language: str, args: List[Any],
+               model: str) -> str:
+    '''Returns a hash of everything that determines a metric value: the metric
+    function, the language, the input texts and the model that computes it.
+    '''
+    metric_fn_name = f'{metric_fn.__module__}.{metric_fn.__qualname__}'
+    key = json.dumps([metric_fn_name, language, args, model],
+                     ensure_ascii=False)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_or_compute(
+    metric_fn: Callable[..., Any], language: str, args: List[Any], model: str,
+    compute: Callable[[], Tuple[Optional[float], Optional[str]]]
+) -> Tuple[Optional[float], Optional[str]]:
+    '''Returns the cached (metric value, explanation) for the inputs, or calls
+    `compute` and caches its result.
+
+    The cache lives in the SQLite database, so it survives restarts and is
+    shared by all worker processes.
+    '''
+    if not _is_enabled():
+        return compute()
+
+    ttl = float(os.environ.get('METRIC_CACHE_TTL_SECONDS', '604800'))
+    key = _cache_key(metric_fn, language, args, model)
+    cached = db.get_cached_metric(key, time.time() - ttl)
+    _record_lookup(key, cached is not None)
+    flush()
+    if cached is not None:
+        return cached
+
+    metric_value, explanation = compute()
+    # Don't cache failures (e.g. the OpenAI API didn't return a valid score)
+    if metric_value is not None:
+        db.insert_cached_metric(key, metric_value, explanation)
+        _maybe_evict(ttl)
+    return metric_value, explanation
+
+
+def _maybe_evict(ttl: float) -> None:
+    global _num_inserts
+    _num_inserts += 1
+    if _num_inserts % EVICTION_INTERVAL == 0:
+        max_entries = int(os.environ.get('METRIC_CACHE_MAX_ENTRIES', '100000'))
+        db.evict_cached_metrics(time.time() - ttl, max_entries)
+
+
+def _record_lookup(key: str, hit: bool) -> None:
+    name = 'hits' if hit else 'misses'
+    with _pending_lock:
+        _pending_counts[name] = _pending_counts.get(name, 0) + 1
+        if hit:
+            _pending_accesses[key] = time.time()
+
+
+def flush(force: bool = False) -> None:
+    '''Writes the hit/miss counts and access times of this process to the db,
+    at most every FLUSH_INTERVAL_SECONDS unless `force` is True.
+    '''
+    global _pending_counts, _pending_accesses, _last_flush
+    with _pending_lock:
+        due = (force
+               or time.monotonic() - _last_flush >= FLUSH_INTERVAL_SECONDS)
+        if not _pending_counts or not due:
+            return
+        counts = _pending_counts
+        accesses = _pending_accesses
+        _pending_counts = {}
+        _pending_accesses = {}
+        _last_flush = time.monotonic()
+    try:
+        db.update_metric_cache_stats(counts, accesses)
+    except Exception:
+        # Losing some counts is better than failing the metric
+        print('Failed to save the metric cache stats:', file=sys.stderr)
+        traceback.print_exc()
+
+
+atexit.register(flush, force=True)
+
+
+def stats() -> Dict[str, Any]:
+    '''Returns the hit/miss counters of all processes and the cache size. The
+    counts of other processes may be up to FLUSH_INTERVAL_SECONDS behind.
+    '''
+    flush(force=True)
+    cache_stats = db.get_metric_cache_stats()
+    hits = cache_stats.get('hits', 0)
+    misses = cache_stats.get('misses', 0)
+    lookups = hits + misses
+    return {
+        'enabled': _is_enabled(),
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / lookups if lookups > 0 else None,
+        'entries': cache_stats['entries']
+    }
@@ -0,0 +1,117 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Union
+
+# Queue that the metric worker processes publish events to, and the id of the
+# process that reads from it
+_events: Optional[Any] = None
+_listener_pid: Optional[int] = None
+
+
+class AsyncSubscriber:
+    '''Receives the events of a chat log on an event loop, so that waiting
+    for them doesn't hold a thread.
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._events: asyncio.Queue = asyncio.Queue()
+
+    def put(self, event: Dict[str, Any]) -> None:
+        # Called by the thread that dispatches the events
+        try:
+            self._loop.call_soon_threadsafe(self._events.put_nowait, event)
+        except RuntimeError:
+            # The event loop was closed before unsubscribing
+            pass
+
+    async def get(self) -> Dict[str, Any]:
+        return await self._events.get()
+
+
+Subscriber = Union[queue.Queue, AsyncSubscriber]
+
+_subscribers: Dict[int, List[Subscriber]] = defaultdict(list)
+_subscribers_lock = threading.Lock()
+
+
+def start_listener() -> None:
+    '''Creates the queue that metric events are published to and starts a
+    thread that forwards them to the subscribers of this process.
+
+    This must be called before the worker processes are forked, so that they
+    inherit the queue.
+    '''
+    global _events, _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    _events = multiprocessing.get_context('fork').Queue()
+    _listener_pid = os.getpid()
+    threading.Thread(target=_listen, args=(_events, ), daemon=True).start()
+
+
+def _listen(events) -> None:
+    while True:
+        log_id, event = events.get()
+        _dispatch(log_id, event)
+
+
+def _dispatch(log_id: int, event: Dict[str, Any]) -> None:
+    with _subscribers_lock:
+        subscribers = list(_subscribers.get(log_id, []))
+    for subscriber in subscribers:
+        subscriber.put(event)
+
+
+def publish(log_id: int, event: Dict[str, Any]) -> None:
+    '''Notifies the subscribers of the chat log that a metric value or the
+    status has changed. This is a no-op if nobody is listening (e.g. when
+    metrics are computed from the command line).
+    '''
+    if _listener_pid == os.getpid():
+        _dispatch(log_id, event)
+    elif _events is not None:
+        _events.put((log_id, event))
+
+
+def publish_metric(log_id: int, metric_name: str,
+                   metric_value: Optional[float],
+                   explanation: Optional[str]) -> None:
+    publish(
+        log_id, {
+            'metric_name': metric_name,
+            'metric_value': metric_value,
+            'explanation': explanation
+        })
+
+
+def publish_status(log_id: int, status: str) -> None:
+    publish(log_id, {'status': status})
+
+
+def subscribe(log_id: int) -> queue.Queue:
+    subscriber: queue.Queue = queue.Queue()
+    with _subscribers_lock:
+        _subscribers[log_id].append(subscriber)
+    return subscriber
+
+
+def asubscribe(log_id: int) -> AsyncSubscriber:
+    '''Same as `subscribe`, but the events are received by awaiting the
+    subscriber's `get` on the running event loop.
+    '''
+    subscriber = AsyncSubscriber(asyncio.get_running_loop())
+    with _subscribers_lock:
+        _subscribers[log_id].append(subscriber)
+    return subscriber
+
+
+def unsubscribe(log_id: int, subscriber: Subscriber) -> None:
+    with _subscribers_lock:
+        _subscribers[log_id].remove(subscriber)
+        if not _subscribers[log_id]:
+            del _subscribers[log_id]
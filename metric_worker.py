@@ -0,0 +1,219 @@
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+import batch_metrics
+import calculate_metrics
+import calculate_reference_metrics
+import database as db
+import instrumentation
+import metric_cache
+import metric_events
+import model_registry
+
+load_dotenv()
+
+# Number of recent jobs kept around to compute latency statistics
+LATENCY_WINDOW = 100
+
+
+def _init_worker():
+    '''Runs once when a worker process starts. The local models are normally
+    loaded by the parent process before it forks the workers, in which case
+    this does nothing.
+    '''
+    model_registry.load(model_registry.get_languages())
+
+
+def _run_batcher() -> None:
+    _init_worker()
+    batch_metrics.main()
+
+
+def _ping() -> None:
+    return
+
+
+def _timed_call(fn: Callable[..., Any], *args) -> Tuple[float, float]:
+    '''Runs a job inside a worker and returns its start time and duration.
+    '''
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        fn(*args)
+        return started_at, time.perf_counter() - start
+    finally:
+        # The worker may stay idle for a while after the job, so its timings
+        # and metric cache stats are saved right away
+        instrumentation.flush(force=True)
+        metric_cache.flush(force=True)
+
+
+class MetricWorkerPool:
+    '''A pool of long-lived worker processes that compute metrics.
+
+    Each worker loads the LangCheck models once at startup and then runs
+    `calculate_metrics.main` and `calculate_reference_metrics.main` jobs from a
+    shared queue, so a chat turn no longer pays for starting a new Python
+    interpreter and reloading the models.
+    '''
+
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._latencies: Deque[Dict[str, Any]] = deque(maxlen=LATENCY_WINDOW)
+        self._batcher: Optional[multiprocessing.process.BaseProcess] = None
+
+    def start(self) -> None:
+        '''Starts the worker processes without waiting for a job. With the
+        fork start method, the executor launches all of its workers on the
+        first submission.
+
+        In batch mode, this also starts the process that computes the local
+        metrics of many chat logs at once (see batch_metrics.py).
+        '''
+        # The workers and the batcher query the tables as soon as they start,
+        # which may be before the app itself initializes the db
+        db.initialize_db()
+        self._get_executor().submit(_ping)
+        if (os.environ.get('METRIC_BATCH_MODE', 'False') == 'True'
+                and self._batcher is None):
+            metric_events.start_listener()
+            self._batcher = multiprocessing.get_context('fork').Process(
+                target=_run_batcher, daemon=True)
+            self._batcher.start()
+
+    def submit(self, job_name: str, fn: Callable[..., Any], *args) -> Future:
+        submitted_at = time.time()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._get_executor().submit(_timed_call, fn, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OOM killer), so start over with
+            # a fresh set of workers
+            with self._lock:
+                self._executor = None
+            future = self._get_executor().submit(_timed_call, fn, *args)
+        future.add_done_callback(
+            lambda f: self._on_job_done(job_name, submitted_at, f))
+        return future
+
+    def stats(self) -> Dict[str, Any]:
+        '''Returns the queue depth and the latency of recent jobs in seconds.
+        '''
+        with self._lock:
+            latencies = list(self._latencies)
+            in_flight = self._in_flight
+            completed = self._completed
+            failed = self._failed
+
+        def _summary(key: str) -> Dict[str, Optional[float]]:
+            values = [latency[key] for latency in latencies]
+            if not values:
+                return {'mean': None, 'max': None, 'last': None}
+            return {
+                'mean': sum(values) / len(values),
+                'max': max(values),
+                'last': values[-1]
+            }
+
+        return {
+            'processes': self.processes,
+            'in_flight': in_flight,
+            'queue_depth': max(0, in_flight - self.processes),
+            'completed': completed,
+            'failed': failed,
+            'queue_wait_seconds': _summary('queue_wait_seconds'),
+            'run_seconds': _summary('run_seconds'),
+            'recent_jobs': latencies[-10:]
+        }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Fork so that workers inherit the already imported modules
+                # instead of re-importing the app, and the queue they publish
+                # metric events to
+                metric_events.start_listener()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=_init_worker)
+            return self._executor
+
+    def _on_job_done(self, job_name: str, submitted_at: float,
+                     future: Future) -> None:
+        exception = future.exception()
+        with self._lock:
+            self._in_flight -= 1
+            if exception is not None:
+                self._failed += 1
+            else:
+                self._completed += 1
+                started_at, run_seconds = future.result()
+                queue_wait_seconds = max(0.0, started_at - submitted_at)
+                self._latencies.append({
+                    'job': job_name,
+                    'queue_wait_seconds': queue_wait_seconds,
+                    'run_seconds': run_seconds
+                })
+        if exception is not None:
+            print(f'Metric job {job_name} failed:', file=sys.stderr)
+            traceback.print_exception(type(exception), exception,
+                                      exception.__traceback__)
+
+
+_pool: Optional[MetricWorkerPool] = None
+_pool_pid: Optional[int] = None
+
+
+def get_pool() -> MetricWorkerPool:
+    '''Returns the worker pool of the current process. A process that was
+    forked from one that already owns a pool (e.g. a gunicorn worker) gets its
+    own pool, since the executor cannot be shared across a fork.
+    '''
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = MetricWorkerPool(
+            int(os.environ.get('METRIC_WORKER_PROCESSES', '2')))
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def start() -> None:
+    get_pool().start()
+
+
+def submit_metrics(log_id: int) -> Future:
+    return get_pool().submit('metrics', calculate_metrics.main, log_id)
+
+
+def submit_reference_metrics(log_id: int, reference: str) -> Future:
+    return get_pool().submit('reference_metrics',
+                             calculate_reference_metrics.main, log_id,
+                             reference)
+
+
+def stats() -> Dict[str, Any]:
+    return get_pool().stats()
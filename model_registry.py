@@ -0,0 +1,134 @@
+import os
+import resource
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+import quantization
+from calculate_metrics import (AI_DISCLAIMER_SIMILARITY_FNS,
+                               FACTUAL_CONSISTENCY_FNS, FLUENCY_FNS,
+                               SENTIMENT_FNS, TOXICITY_FNS)
+
+load_dotenv()
+
+# The local model-based metrics, along with the arguments of a dummy input that
+# makes langcheck load the model
+LOCAL_MODEL_METRICS = {
+    'factual_consistency': (FACTUAL_CONSISTENCY_FNS, [['Hello'], ['Hello']]),
+    'toxicity': (TOXICITY_FNS, [['Hello']]),
+    'sentiment': (SENTIMENT_FNS, [['Hello']]),
+    'fluency': (FLUENCY_FNS, [['Hello']]),
+    'ai_disclaimer_similarity': (AI_DISCLAIMER_SIMILARITY_FNS, [['Hello']])
+}
+
+_loaded_languages: List[str] = []
+_model_stats: List[Dict[str, Any]] = []
+_lock = threading.Lock()
+
+
+def _get_rss_bytes() -> int:
+    '''Returns the resident memory of this process.
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Not Linux, so fall back to the peak resident memory
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def get_languages() -> List[str]:
+    languages = os.environ.get('METRIC_WORKER_WARMUP_LANGUAGES', 'en')
+    return [language.strip() for language in languages.split(',')]
+
+
+def load(languages: List[str]) -> None:
+    '''Loads the models of the local metrics for the languages and runs each
+    one once, so that the first real request doesn't pay for loading them.
+
+    Models are loaded once per process: a process forked after this (e.g. a
+    metric worker, or a gunicorn worker with `preload_app`) shares the loaded
+    models with its parent instead of loading them again.
+
+    The models of the metrics in LOCAL_MODEL_QUANTIZED_METRICS are quantized
+    to int8, unless that changes their values on a fixed sample by more than
+    LOCAL_MODEL_QUANTIZATION_TOLERANCE (see quantization.py).
+    '''
+    if os.environ['ENABLE_LOCAL_LANGCHECK_MODELS'] != 'True':
+        return
+    quantized_metrics = quantization.get_quantized_metrics()
+    tolerance = float(
+        os.environ.get('LOCAL_MODEL_QUANTIZATION_TOLERANCE', '0.05'))
+    with _lock:
+        for language in languages:
+            if language in _loaded_languages:
+                continue
+            for metric_name, (metric_fns, args) in LOCAL_MODEL_METRICS.items():
+                if language not in metric_fns:
+                    continue
+                metric_fn = metric_fns[language]
+                quantize = metric_name in quantized_metrics
+                if quantize:
+                    model_ids_before = quantization.get_model_ids()
+                rss_before = _get_rss_bytes()
+                start = time.perf_counter()
+                metric_fn(*args)
+                load_seconds = time.perf_counter() - start
+                rss_increase_mb = (_get_rss_bytes() - rss_before) / 2**20
+                model_stats = {
+                    'metric_name': metric_name,
+                    'language': language,
+                    'load_seconds': load_seconds,
+                    'rss_increase_mb': rss_increase_mb,
+                    'inference_mode': 'float'
+                }
+                if quantize:
+                    models = quantization.find_new_models(model_ids_before)
+                    sample_args = quantization.get_sample_args(
+                        metric_name, language)
+                    model_stats.update(
+                        quantization.quantize_and_check(
+                            models,
+                            lambda: metric_fn(*sample_args).metric_values,
+                            tolerance))
+                _model_stats.append(model_stats)
+            _loaded_languages.append(language)
+
+
+def get_inference_mode(metric_fn: Callable[..., Any],
+                       language: str) -> Optional[str]:
+    '''Returns whether the model of a local metric runs in 'int8' or 'float'
+    in this process, or None if the metric doesn't use a model.
+    '''
+    metric_names = [
+        metric_name
+        for metric_name, (metric_fns, _) in LOCAL_MODEL_METRICS.items()
+        if metric_fns.get(language) is metric_fn
+    ]
+    if not metric_names:
+        return None
+    with _lock:
+        for model_stats in _model_stats:
+            if (model_stats['metric_name'] == metric_names[0]
+                    and model_stats['language'] == language):
+                return model_stats['inference_mode']
+    # The model wasn't loaded by `load` (e.g. ENABLE_LOCAL_LANGCHECK_MODELS is
+    # 'False'), so langcheck loads it as is
+    return 'float'
+
+
+def stats() -> Dict[str, Any]:
+    '''Returns how long each model took to load and warm up, how much it
+    increased the resident memory of the process that loaded it, and whether it
+    runs quantized.
+    '''
+    with _lock:
+        return {
+            'languages': list(_loaded_languages),
+            'models': list(_model_stats),
+            'rss_mb': _get_rss_bytes() / 2**20
+        }
@@ -0,0 +1,140 @@
+import gc
+import os
+import time
+import warnings
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import torch
+from torch.ao.nn.quantized import dynamic as quantized_dynamic
+from torch.ao.quantization import default_dynamic_qconfig
+
+# Fixed inputs that the float and quantized models are compared on
+SAMPLE_TEXTS = {
+    'en': [
+        'LangCheck is a library of metrics to evaluate LLM applications.',
+        'You are an idiot and nobody wants to hear from you.',
+        'I really enjoyed using this library, it saved me a lot of time!',
+        'the cat sat on mat the quickly because tomorrow'
+    ],
+    'ja': [
+        'LangCheckはLLMアプリケーションを評価するためのライブラリです。', 'お前は本当に馬鹿だな。',
+        'このライブラリのおかげで作業がとても楽になりました！', '猫が明日すぐにマットの上で座った'
+    ],
+    'de': [
+        'LangCheck ist eine Bibliothek zur Bewertung von LLM-Anwendungen.',
+        'Du bist ein Idiot und niemand will dir zuhören.',
+        'Die Bibliothek hat mir viel Zeit gespart, danke!',
+        'die Katze auf Matte sitzt morgen schnell weil'
+    ],
+    'zh': [
+        'LangCheck是一个用于评估LLM应用程序的库。', '你真是个白痴，没人想听你说话。', '这个库帮我节省了很多时间，非常感谢！',
+        '猫明天很快地坐在垫子上因为'
+    ]
+}
+
+
+def get_quantized_metrics() -> List[str]:
+    '''Returns the names of the local metrics whose models run with int8
+    dynamic quantization.
+    '''
+    metric_names = os.environ.get('LOCAL_MODEL_QUANTIZED_METRICS', '')
+    return [name.strip() for name in metric_names.split(',') if name.strip()]
+
+
+def get_sample_args(metric_name: str, language: str) -> List[List[str]]:
+    texts = SAMPLE_TEXTS.get(language, SAMPLE_TEXTS['en'])
+    if metric_name == 'factual_consistency':
+        # Pair each text with a source that does and doesn't support it
+        return [texts * 2, texts + texts[1:] + texts[:1]]
+    return [texts]
+
+
+def _get_models() -> List[torch.nn.Module]:
+    # Checking the type of some objects warns about deprecated torch APIs
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return [
+            obj for obj in gc.get_objects()
+            if isinstance(obj, torch.nn.Module)
+        ]
+
+
+def get_model_ids() -> Set[int]:
+    return {id(model) for model in _get_models()}
+
+
+def find_new_models(model_ids_before: Set[int]) -> List[torch.nn.Module]:
+    '''Returns the top-level torch models that were created since
+    `get_model_ids` returned `model_ids_before`, e.g. the models that langcheck
+    loaded while computing a metric for the first time.
+    '''
+    new_models = [
+        model for model in _get_models() if id(model) not in model_ids_before
+    ]
+    submodule_ids = {
+        id(submodule)
+        for model in new_models
+        for submodule in model.modules() if submodule is not model
+    }
+    return [model for model in new_models if id(model) not in submodule_ids]
+
+
+def _quantize(
+    models: List[torch.nn.Module]
+) -> List[Tuple[torch.nn.Module, str, torch.nn.Module]]:
+    '''Replaces the linear layers of the models with int8 dynamically quantized
+    ones in place, so that langcheck keeps using the same model objects. Returns
+    the replaced layers as (parent, name, layer), to be able to revert.
+    '''
+    replaced = []
+    for model in models:
+        for parent in list(model.modules()):
+            for name, child in list(parent.named_children()):
+                if type(child) is not torch.nn.Linear:
+                    continue
+                child.qconfig = default_dynamic_qconfig
+                setattr(parent, name,
+                        quantized_dynamic.Linear.from_float(child))
+                replaced.append((parent, name, child))
+    return replaced
+
+
+def _revert(
+        replaced: List[Tuple[torch.nn.Module, str, torch.nn.Module]]) -> None:
+    for parent, name, child in replaced:
+        setattr(parent, name, child)
+
+
+def quantize_and_check(models: List[torch.nn.Module],
+                       compute: Callable[[], List[Optional[float]]],
+                       tolerance: float) -> Dict[str, Any]:
+    '''Quantizes the models, and keeps the quantized models only if the metric
+    values that `compute` returns on a fixed sample differ by at most
+    `tolerance` from those of the float models. Returns the result of the
+    check and the CPU time of `compute` with the float and quantized models.
+    '''
+    start = time.process_time()
+    float_values = compute()
+    float_cpu_seconds = time.process_time() - start
+
+    replaced = _quantize(models)
+    start = time.process_time()
+    quantized_values = compute()
+    quantized_cpu_seconds = time.process_time() - start
+
+    differences = [
+        abs(float_value - quantized_value)
+        for float_value, quantized_value in zip(float_values, quantized_values)
+        if float_value is not None and quantized_value is not None
+    ]
+    max_difference = max(differences, default=0.0)
+    quantized = bool(replaced) and max_difference <= tolerance
+    if not quantized:
+        _revert(replaced)
+    return {
+        'inference_mode': 'int8' if quantized else 'float',
+        'quantized_layers': len(replaced) if quantized else 0,
+        'max_difference': max_difference,
+        'float_cpu_seconds': float_cpu_seconds,
+        'quantized_cpu_seconds': quantized_cpu_seconds
+    }
@@ -0,0 +1,238 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, Hashable,
+                    Iterator, List, Set, Tuple)
+
+
+def _wake(waiter: 'asyncio.Future') -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Broadcast:
+    '''A stream of items put by one producer and read by any number of
+    readers, each of which gets every item from the start, followed by the
+    result (or exception) of the stream.
+
+    Works both from threads (iterating it and `result`) and from coroutines
+    (`aiter` and `aresult`).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._items: List[Any] = []
+        self._done = False
+        self._result: Future = Future()
+        # The readers waiting on an event loop for the next item
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop,
+                                        asyncio.Future]] = []
+
+    def _notify(self) -> None:
+        # Called with the lock held
+        self._changed.notify_all()
+        for loop, waiter in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # The event loop was closed while the reader was waiting
+                pass
+        self._async_waiters = []
+
+    def put(self, item: Any) -> None:
+        with self._lock:
+            self._items.append(item)
+            self._notify()
+
+    def finish(self, result: Any) -> None:
+        self._result.set_result(result)
+        with self._lock:
+            self._done = True
+            self._notify()
+
+    def fail(self, exception: BaseException) -> None:
+        self._result.set_exception(exception)
+        with self._lock:
+            self._done = True
+            self._notify()
+
+    def __iter__(self) -> Iterator[Any]:
+        num_read = 0
+        while True:
+            with self._lock:
+                while num_read == len(self._items) and not self._done:
+                    self._changed.wait()
+                items = self._items[num_read:]
+                done = self._done
+            num_read += len(items)
+            yield from items
+            if done:
+                return
+
+    async def aiter(self) -> AsyncIterator[Any]:
+        loop = asyncio.get_running_loop()
+        num_read = 0
+        while True:
+            with self._lock:
+                items = self._items[num_read:]
+                done = self._done
+                if not items and not done:
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+            num_read += len(items)
+            for item in items:
+                yield item
+            if done and not items:
+                return
+            if not items:
+                await waiter
+
+    def result(self) -> Any:
+        return self._result.result()
+
+    def add_done_callback(self, fn: Callable[[Future], Any]) -> None:
+        '''Calls `fn` with the future of the result once it's set.
+        '''
+        self._result.add_done_callback(fn)
+
+    async def aresult(self) -> Any:
+        return await asyncio.wrap_future(self._result)
+
+
+class SingleFlight:
+    '''Coalesces concurrent calls with the same key: the first call runs the
+    function, and the calls that arrive while it's running wait for it and get
+    its result (or exception) instead of running the function again.
+
+    Works both from threads (`do`) and from coroutines (`ado`), which can share
+    the same keys. Calls that stream their result are coalesced with `stream`
+    and `astream`.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # The Future (or Broadcast for streams) of the call in flight per key
+        self._calls: Dict[Hashable, Any] = {}
+        self._num_calls = 0
+        self._num_shared = 0
+        # Keeps the tasks started by `astream` from being garbage collected
+        self._tasks: Set['asyncio.Task'] = set()
+
+    def _join(self,
+              key: Hashable,
+              factory: Callable[[], Any] = Future) -> Tuple[Any, bool]:
+        '''Returns the future of the call in flight for the key, and whether
+        the caller is the first one and so has to run the call.
+        '''
+        with self._lock:
+            self._num_calls += 1
+            future = self._calls.get(key)
+            if future is not None:
+                self._num_shared += 1
+                return future, False
+            future = factory()
+            self._calls[key] = future
+            return future, True
+
+    def _finish(self, key: Hashable) -> None:
+        with self._lock:
+            del self._calls[key]
+
+    def do(self, key: Hashable, fn: Callable[..., Any],
+           *args) -> Tuple[Any, bool]:
+        '''Returns the result of `fn(*args)`, and whether it was shared with
+        an earlier call with the same key.
+        '''
+        future, first = self._join(key)
+        if not first:
+            return future.result(), True
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._finish(key)
+        future.set_result(result)
+        return result, False
+
+    async def ado(self, key: Hashable, fn: Callable[..., Awaitable[Any]],
+                  *args) -> Tuple[Any, bool]:
+        '''Same as `do`, but awaits the coroutine function `fn` and waits for
+        the call in flight without blocking the event loop.
+        '''
+        future, first = self._join(key)
+        if not first:
+            return await asyncio.wrap_future(future), True
+        try:
+            result = await fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._finish(key)
+        future.set_result(result)
+        return result, False
+
+    def stream(self, key: Hashable, fn: Callable[..., Any],
+               *args) -> Tuple[Broadcast, bool]:
+        '''Returns the broadcast of the call in flight for the key, and whether
+        it was started by an earlier call. The first call runs
+        `fn(broadcast, *args)` on a new thread, which puts the items in the
+        broadcast and returns its result. It runs on its own thread so that it
+        completes for the later calls even if the first caller stops reading.
+        '''
+        broadcast, first = self._join(key, Broadcast)
+        if first:
+            threading.Thread(target=self._produce,
+                             args=(key, broadcast, fn, *args),
+                             daemon=True).start()
+        return broadcast, not first
+
+    def _produce(self, key: Hashable, broadcast: Broadcast,
+                 fn: Callable[..., Any], *args) -> None:
+        try:
+            result = fn(broadcast, *args)
+        except BaseException as e:
+            # Raised to the readers
+            broadcast.fail(e)
+            return
+        finally:
+            self._finish(key)
+        broadcast.finish(result)
+
+    def astream(self, key: Hashable, fn: Callable[..., Awaitable[Any]],
+                *args) -> Tuple[Broadcast, bool]:
+        '''Same as `stream`, but runs the coroutine function `fn` as a task on
+        the running event loop.
+        '''
+        broadcast, first = self._join(key, Broadcast)
+        if first:
+            task = asyncio.get_running_loop().create_task(
+                self._aproduce(key, broadcast, fn, *args))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return broadcast, not first
+
+    async def _aproduce(self, key: Hashable, broadcast: Broadcast,
+                        fn: Callable[..., Awaitable[Any]], *args) -> None:
+        try:
+            result = await fn(broadcast, *args)
+        except BaseException as e:
+            broadcast.fail(e)
+            return
+        finally:
+            self._finish(key)
+        broadcast.finish(result)
+
+    def stats(self) -> Dict[str, Any]:
+        '''Returns the number of calls, how many of them shared the result of
+        another call, and the number of calls in flight.
+        '''
+        with self._lock:
+            return {
+                'calls': self._num_calls,
+                'shared': self._num_shared,
+                'in_flight': len(self._calls)
+            }
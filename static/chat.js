@@ -2,12 +2,12 @@
 * Page setup
 *************************************************************************/
 
-let metricsPollingInterval;
+let metricsEventSource;
 let chatEndpoint;
 if (document.location.pathname == '/demo') {
-  chatEndpoint = '/api/chat_demo'  // Get canned responses to speed up live demos
+  chatEndpoint = '/api/chat_demo_stream'  // Get canned responses to speed up live demos
 } else {
-  chatEndpoint = '/api/chat'
+  chatEndpoint = '/api/chat_stream'
 }
 
 $('#send-button').click(sendMessage);
@@ -63,15 +63,25 @@ function sendMessage() {
   // Hide the "Reference-Based Text Quality Metrics" table by default
   $('#reference-based-metrics-container').hide();
 
-  $.post({
-    url: chatEndpoint,
-    data: JSON.stringify({ message: question, language: language }),
-    contentType: 'application/json;charset=UTF-8',
-    dataType: 'json',
-  }).then(function (data) {
+  // Stream the answer as it is generated. The final "done" event has the
+  // same fields as the /api/chat response.
+  let answer = '';
+  streamChat(question, language, function (event, data) {
+    if (event === 'token') {
+      answer += data.token;
+      $('#spinner-container').remove();
+      if ($('#streaming-answer').length === 0) {
+        $('#chat-window').append('<div id="streaming-answer" class="qa-block"></div>');
+      }
+      $('#streaming-answer').html(
+        `<span class="text-success" style="font-weight: 500;">Answer: </span>${marked.parse(answer)}`);
+      return;
+    }
+
     // Append the bot's answer
     $('#metrics-and-sources-container').show();
     $('#spinner-container').remove();
+    $('#streaming-answer').remove();
     $('#reference-input').show();
     $('#submit-ref-button').prop('disabled', true);
     $('#submit-ref-button').tooltip({'trigger': 'hover'});
@@ -82,15 +92,44 @@ function sendMessage() {
     // Save the log_id into the global variable
     logID = data.id;
 
-    // Poll metrics every second
-    if (metricsPollingInterval !== undefined) {
-      clearInterval(metricsPollingInterval);
-    }
-    metricsPollingInterval = setInterval(updateMetrics.bind(null, logID), 1000);
-    updateMetrics(logID);  // So the table isn't empty for 1 second
+    watchMetrics(logID);
   });
 }
 
+// Post the question to the streaming chat endpoint and call onEvent(event,
+// data) for each server-sent event in the response
+async function streamChat(question, language, onEvent) {
+  const response = await fetch(chatEndpoint, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json;charset=UTF-8' },
+    body: JSON.stringify({ message: question, language: language }),
+  });
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) { break; }
+    buffer += decoder.decode(value, { stream: true });
+    // Events are separated by a blank line
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      let event = 'message';
+      let data = '';
+      for (const line of rawEvent.split('\n')) {
+        if (line.startsWith('event: ')) {
+          event = line.slice('event: '.length);
+        } else if (line.startsWith('data: ')) {
+          data += line.slice('data: '.length);
+        }
+      }
+      onEvent(event, JSON.parse(data));
+    }
+  }
+}
+
 function calculateReferenceBasedTextQuality(e) {
   const reference = $('#user-ref-input').val();
   if (reference.trim() === "") { return; }  // Don't send an empty message
@@ -107,12 +146,7 @@ function calculateReferenceBasedTextQuality(e) {
     contentType: 'application/json;charset=UTF-8',
     dataType: 'json',
   }).then(function () {
-    // Poll metrics every second
-    if (metricsPollingInterval !== undefined) {
-      clearInterval(metricsPollingInterval);
-    }
-    metricsPollingInterval = setInterval(updateMetrics.bind(null, logID), 1000);
-    updateMetrics(logID);  // So the table isn't empty for 1 second
+    watchMetrics(logID);
   });
 }
 
@@ -152,80 +186,100 @@ function generateAnswerRow(answer, factualConsistencyScore, warning) {
   `;
 }
 
-function updateMetrics(id) {
-  $.get(`/api/metrics/${id}`)
-    .then(function (data) {
-      $('#metrics-table-container tbody').empty();
-      // Add a row with a spinner if the status is still "new"
-      if (data.status === 'new') {
-        $('#metrics-table-container tbody').append(`<tr><td colspan="2" style="text-align: center;"><div class="spinner-border spinner-border-sm"></div></td></tr>`);
-        return;
-      }
-      for (let metricName in data) {
-        if (metricName === "status") {
-          continue;
-        }
-        let metricTableID = ''
-        if (Object.keys(REFERENCE_FREE_METRICS).includes(metricName)) {
-          metricTableID = '#reference-free-metrics-table';
-        } else if (Object.keys(SOURCE_BASED_METRICS).includes(metricName)) {
-          metricTableID = '#source-based-metrics-table';
-        } else if (Object.keys(REFERENCE_BASED_METRICS).includes(metricName)) {
-          metricTableID = '#reference-based-metrics-table';
-        } else {
-          continue;
-        }
-        // First, add the HTML for the metric name to the row
-        let metricRowHTML = (data[metricName]['explanation'] !== null) ?
-          `<tr>
-            <td id=${metricName}>${metricName}
-              <span class="ml-2 d-none" data-html="true" data-toggle="tooltip" data-placement="top">
-                <span data-feather="help-circle"></span>
-              </span>
-            </td>` :
-          `<tr><td>${metricName}</td>`;
-
-        // Then, add the HTML for the metric value to the row
-        if (data[metricName]['metric_value'] !== null) {
-          if (thresholdExceeded(metricName, data[metricName]['metric_value'])) {
-              metricRowHTML += `<td class="bg-danger text-white">${round(data[metricName]['metric_value'], 4)}</td></tr>`;
-          } else {
-            metricRowHTML += `<td>${round(data[metricName]['metric_value'], 4)}</td></tr>`;
-          }
-        } else {
-          metricRowHTML += `<td><div class="spinner-border spinner-border-sm"></div></td></tr>`;
-        }
+// Subscribe to the metrics of the log, which the server pushes as they are
+// computed, and re-render the metrics table on each update
+function watchMetrics(id) {
+  if (metricsEventSource !== undefined) {
+    metricsEventSource.close();
+  }
+  let data = {};
+  metricsEventSource = new EventSource(`/api/metrics/${id}/stream`);
+  metricsEventSource.addEventListener('snapshot', function (e) {
+    data = JSON.parse(e.data);
+    renderMetrics(data);
+  });
+  metricsEventSource.addEventListener('metric', function (e) {
+    const metric = JSON.parse(e.data);
+    data[metric.metric_name] = {
+      'metric_value': metric.metric_value,
+      'explanation': metric.explanation
+    };
+    renderMetrics(data);
+  });
+  metricsEventSource.addEventListener('status', function (e) {
+    data.status = JSON.parse(e.data).status;
+    renderMetrics(data);
+  });
+}
 
-        $(metricTableID + ' tbody').append(metricRowHTML)
-      }
+function renderMetrics(data) {
+  $('#metrics-table-container tbody').empty();
+  // Add a row with a spinner if the status is still "new"
+  if (data.status === 'new') {
+    $('#metrics-table-container tbody').append(`<tr><td colspan="2" style="text-align: center;"><div class="spinner-border spinner-border-sm"></div></td></tr>`);
+    return;
+  }
+  for (let metricName in data) {
+    if (metricName === "status") {
+      continue;
+    }
+    let metricTableID = ''
+    if (Object.keys(REFERENCE_FREE_METRICS).includes(metricName)) {
+      metricTableID = '#reference-free-metrics-table';
+    } else if (Object.keys(SOURCE_BASED_METRICS).includes(metricName)) {
+      metricTableID = '#source-based-metrics-table';
+    } else if (Object.keys(REFERENCE_BASED_METRICS).includes(metricName)) {
+      metricTableID = '#reference-based-metrics-table';
+    } else {
+      continue;
+    }
+    // First, add the HTML for the metric name to the row
+    let metricRowHTML = (data[metricName]['explanation'] !== null) ?
+      `<tr>
+        <td id=${metricName}>${metricName}
+          <span class="ml-2 d-none" data-html="true" data-toggle="tooltip" data-placement="top">
+            <span data-feather="help-circle"></span>
+          </span>
+        </td>` :
+      `<tr><td>${metricName}</td>`;
 
-      if (data.status === 'done') {
-        // Add OpenAI metrics explanation
-        getMetricsExplanation(id);
-        // Stop polling if metrics computation is done
-        clearInterval(metricsPollingInterval);
-        // Remove the loading indicators, if any
-        $('#metrics-table-container .spinner-border').remove();
-        // Enable the "Submit Reference" button
-        $('#submit-ref-button').prop("disabled", false);
-        // Hide the tooktip for the "Submit Reference" button
-        $('#submit-ref-button').tooltip('dispose');
+    // Then, add the HTML for the metric value to the row
+    if (data[metricName]['metric_value'] !== null) {
+      if (thresholdExceeded(metricName, data[metricName]['metric_value'])) {
+          metricRowHTML += `<td class="bg-danger text-white">${round(data[metricName]['metric_value'], 4)}</td></tr>`;
+      } else {
+        metricRowHTML += `<td>${round(data[metricName]['metric_value'], 4)}</td></tr>`;
       }
-    });
+    } else {
+      metricRowHTML += `<td><div class="spinner-border spinner-border-sm"></div></td></tr>`;
+    }
+
+    $(metricTableID + ' tbody').append(metricRowHTML)
+  }
+
+  if (data.status === 'done') {
+    // Add OpenAI metrics explanation
+    getMetricsExplanation(data);
+    // Stop listening if metrics computation is done
+    metricsEventSource.close();
+    // Remove the loading indicators, if any
+    $('#metrics-table-container .spinner-border').remove();
+    // Enable the "Submit Reference" button
+    $('#submit-ref-button').prop("disabled", false);
+    // Hide the tooktip for the "Submit Reference" button
+    $('#submit-ref-button').tooltip('dispose');
+  }
 }
 
-function getMetricsExplanation(id) {
+function getMetricsExplanation(data) {
   // Add the metric explanation tooltips
-  $.get(`/api/metrics/${id}`)
-  .then(function (data) {
-    for (const metric in data) {
-      if(metric.endsWith('_openai')) {
-        const title = escapeHTML(data[metric]['explanation']);
-        $(`#${metric} span[data-toggle="tooltip"]`).attr('data-original-title', title);
-        $('#metrics-table-container tbody span[data-toggle="tooltip"]').removeClass("d-none");
-      }
+  for (const metric in data) {
+    if(metric.endsWith('_openai')) {
+      const title = escapeHTML(data[metric]['explanation']);
+      $(`#${metric} span[data-toggle="tooltip"]`).attr('data-original-title', title);
+      $('#metrics-table-container tbody span[data-toggle="tooltip"]').removeClass("d-none");
     }
-  });
+  }
   feather.replace();
   $('[data-toggle="tooltip"]').tooltip();
 }
@@ -1,13 +1,23 @@
 let currentPage = 1;
+// The cursor of each page we've visited so far (the first page has none), and
+// the cursor of the page after the current one
+let pageCursors = [null];
+let nextCursor = null;
 
 function loadLogs(direction) {
     if (direction === 'next') {
+        if (nextCursor === null) { return; }  // This is the last page
         currentPage += 1;
+        pageCursors.push(nextCursor);
     } else if (direction === 'prev' && currentPage > 1) {
         currentPage -= 1;
+        pageCursors.pop();
     }
+    const cursor = pageCursors[pageCursors.length - 1];
+    const url = cursor === null ? '/api/logs' : '/api/logs?before=' + encodeURIComponent(cursor);
     $('#qa-table tr:not(:first)').remove();  // Remove all rows except headers
-    $.get('/api/logs?page=' + currentPage, function(data) {
+    $.get(url, function(data) {
+        nextCursor = data.next_cursor;
         data.logs.forEach(log => {
             // Construct the rows of the metrics table. `log` has a field
             // `metrics` which is a JSON object with the metric names as keys
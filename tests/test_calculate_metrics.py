@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+import calculate_metrics
+
+WORDS = [
+    'LangCheck', 'metrics', 'evaluate', 'the', 'outputs', 'of', 'LLM',
+    'applications', 'with', 'toxicity', 'fluency', 'and', 'factual',
+    'consistency', 'scores', '(e.g.', '0.95),', 'computed', 'locally', 'or',
+    'by', 'OpenAI', 'models', 'in', 'English,', 'Japanese', 'German.'
+]
+
+
+def _random_text(rng, num_words):
+    return ' '.join(rng.choices(WORDS, k=num_words))
+
+
+@pytest.fixture
+def model_tokenizer():
+    try:
+        return calculate_metrics.get_tokenizer(
+            calculate_metrics.FACTUAL_CONSISTENCY_MODEL)
+    except OSError:
+        pytest.skip('The tokenizer of the factual consistency model is not '
+                    'in the Hugging Face cache')
+
+
+def test_split_source_windows_fit_in_the_model_input(model_tokenizer):
+    rng = random.Random(0)
+    response = _random_text(rng, 120)
+    source = _random_text(rng, 5000)
+
+    windows = calculate_metrics.split_source(source, response, 'en')
+
+    assert len(windows) > 1
+    assert source.startswith(windows[0])
+    assert source.endswith(windows[-1])
+    for window in windows:
+        model_input = calculate_metrics.FACTUAL_CONSISTENCY_PROMPT.format(
+            claim=response) + window
+        num_tokens = len(model_tokenizer(model_input)['input_ids'])
+        assert num_tokens <= calculate_metrics.FACTUAL_CONSISTENCY_MAX_TOKENS
+
+
+def test_split_source_keeps_short_sources_whole(model_tokenizer):
+    source = 'LangCheck is a library of metrics to evaluate LLM applications.'
+
+    assert calculate_metrics.split_source(source, 'Yes.', 'en') == [source]
@@ -0,0 +1,280 @@
+import json
+import os
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (BasePydanticVectorStore,
+                                                  VectorStoreQuery,
+                                                  VectorStoreQueryResult)
+
+# Files that the IVF vector store is saved to, in the index directory
+IVF_VECTORS_FILE = 'ivf_vectors.npy'
+IVF_ASSIGNMENTS_FILE = 'ivf_assignments.npy'
+IVF_CENTROIDS_FILE = 'ivf_centroids.npy'
+IVF_IDS_FILE = 'ivf_ids.json'
+
+# Below this many vectors, every vector is scored since that's fast enough
+MIN_TRAIN_SIZE = 1024
+# Number of training vectors sampled per cluster, and k-means iterations
+KMEANS_SAMPLES_PER_CLUSTER = 32
+KMEANS_ITERATIONS = 10
+# Number of vectors compared to the centroids at once, which bounds the memory
+# used while assigning vectors to clusters
+ASSIGN_CHUNK_SIZE = 8192
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _nearest_centroids(vectors: np.ndarray,
+                       centroids: np.ndarray) -> np.ndarray:
+    assignments = [
+        np.argmax(vectors[i:i + ASSIGN_CHUNK_SIZE] @ centroids.T, axis=1)
+        for i in range(0, len(vectors), ASSIGN_CHUNK_SIZE)
+    ]
+    return np.concatenate(assignments).astype(np.int32)
+
+
+def _kmeans(vectors: np.ndarray, num_clusters: int,
+            rng: np.random.Generator) -> np.ndarray:
+    '''Clusters normalized vectors by cosine similarity (spherical k-means)
+    and returns the normalized centroids.
+    '''
+    initial = rng.choice(len(vectors), num_clusters, replace=False)
+    centroids = vectors[initial]
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = _nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        # Keep the previous centroid of a cluster that became empty
+        non_empty = counts > 0
+        centroids[non_empty] = _normalize(sums[non_empty])
+    return centroids
+
+
+class IVFVectorStore(BasePydanticVectorStore):
+    '''A vector store for large corpora that keeps the embeddings in a
+    memory-mapped NumPy file and searches them with an inverted file (IVF)
+    index.
+
+    The embeddings are clustered with k-means into about 4 * sqrt(n) clusters,
+    and a query only scores the embeddings in the `nprobe` clusters whose
+    centroids are most similar to it. Retrieval time therefore grows with the
+    square root of the number of embeddings instead of linearly, and only the
+    scored rows of the embedding matrix are read into memory. The clusters are
+    trained again whenever the number of embeddings doubles.
+
+    The node texts are kept in the docstore (`stores_text` is False), and
+    metadata filters are not supported.
+    '''
+
+    stores_text: bool = False
+    nprobe: int = 8
+
+    # Embeddings that were saved to disk (memory-mapped) and that were added
+    # since then (in memory), normalized so that dot products are cosine
+    # similarities
+    _saved_vectors: Optional[np.ndarray] = PrivateAttr(default=None)
+    _added_vectors: Optional[np.ndarray] = PrivateAttr(default=None)
+    _node_ids: List[str] = PrivateAttr(default_factory=list)
+    _ref_doc_ids: List[str] = PrivateAttr(default_factory=list)
+    _deleted: np.ndarray = PrivateAttr(
+        default_factory=lambda: np.zeros(0, dtype=bool))
+    # The cluster centroids, the cluster of each embedding, the embeddings in
+    # each cluster, and the number of embeddings when the clusters were trained
+    _centroids: Optional[np.ndarray] = PrivateAttr(default=None)
+    _assignments: np.ndarray = PrivateAttr(
+        default_factory=lambda: np.zeros(0, dtype=np.int32))
+    _clusters: List[np.ndarray] = PrivateAttr(default_factory=list)
+    _num_trained: int = PrivateAttr(default=0)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'IVFVectorStore'
+
+    @classmethod
+    def from_persist_dir(cls,
+                         persist_dir: str,
+                         nprobe: int = 8) -> 'IVFVectorStore':
+        vector_store = cls(nprobe=nprobe)
+        vector_store._load(persist_dir)
+        return vector_store
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        vectors = _normalize(
+            np.array([node.get_embedding() for node in nodes],
+                     dtype=np.float32))
+        start = len(self._node_ids)
+        if self._added_vectors is None:
+            self._added_vectors = vectors
+        else:
+            self._added_vectors = np.concatenate(
+                [self._added_vectors, vectors])
+        self._node_ids += [node.node_id for node in nodes]
+        self._ref_doc_ids += [node.ref_doc_id or '' for node in nodes]
+        self._deleted = np.concatenate(
+            [self._deleted, np.zeros(len(nodes), dtype=bool)])
+
+        if len(self._node_ids) >= MIN_TRAIN_SIZE and (
+                self._centroids is None
+                or len(self._node_ids) >= 2 * self._num_trained):
+            self._train()
+        elif self._centroids is not None:
+            self._assign(start, _nearest_centroids(vectors, self._centroids))
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        for i, id in enumerate(self._ref_doc_ids):
+            if id == ref_doc_id:
+                self._deleted[i] = True
+
+    def query(self, query: VectorStoreQuery,
+              **kwargs: Any) -> VectorStoreQueryResult:
+        if query.filters is not None:
+            raise ValueError(
+                'IVFVectorStore does not support metadata filters')
+        assert query.query_embedding is not None
+        query_vector = _normalize(
+            np.array(query.query_embedding, dtype=np.float32))
+
+        if self._centroids is None:
+            candidates = np.arange(len(self._node_ids))
+        else:
+            nprobe = min(self.nprobe, len(self._centroids))
+            centroid_scores = self._centroids @ query_vector
+            probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            candidates = np.concatenate(
+                [self._clusters[probe] for probe in probes])
+        # Sort the rows so that they are read from disk in order
+        candidates = np.sort(candidates[~self._deleted[candidates]])
+        if len(candidates) == 0:
+            return VectorStoreQueryResult(ids=[], similarities=[])
+
+        scores = self._get_vectors(candidates) @ query_vector
+        top_k = min(query.similarity_top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return VectorStoreQueryResult(
+            ids=[self._node_ids[i] for i in candidates[top]],
+            similarities=scores[top].tolist())
+
+    def persist(self, persist_path: str, fs: Any = None) -> None:
+        '''Saves the embeddings that were not deleted to the directory of
+        `persist_path`, and memory-maps them from there.
+        '''
+        persist_dir = os.path.dirname(persist_path)
+        os.makedirs(persist_dir, exist_ok=True)
+        live = np.flatnonzero(~self._deleted)
+        vectors_path = os.path.join(persist_dir, IVF_VECTORS_FILE)
+        dim = self._get_vectors(live[:1]).shape[1] if len(live) else 0
+        # Write the embeddings in chunks to a temporary file, since the
+        # current file may be memory-mapped
+        temp_path = vectors_path + '.tmp'
+        saved_vectors = np.lib.format.open_memmap(temp_path,
+                                                  mode='w+',
+                                                  dtype=np.float32,
+                                                  shape=(len(live), dim))
+        for i in range(0, len(live), ASSIGN_CHUNK_SIZE):
+            chunk = live[i:i + ASSIGN_CHUNK_SIZE]
+            saved_vectors[i:i + len(chunk)] = self._get_vectors(chunk)
+        saved_vectors.flush()
+        del saved_vectors
+        os.replace(temp_path, vectors_path)
+
+        if self._centroids is not None:
+            np.save(os.path.join(persist_dir, IVF_CENTROIDS_FILE),
+                    self._centroids)
+            np.save(os.path.join(persist_dir, IVF_ASSIGNMENTS_FILE),
+                    self._assignments[live])
+        with open(os.path.join(persist_dir, IVF_IDS_FILE), 'w') as f:
+            json.dump(
+                {
+                    'node_ids': [self._node_ids[i] for i in live],
+                    'ref_doc_ids': [self._ref_doc_ids[i] for i in live],
+                    'num_trained': self._num_trained
+                }, f)
+        self._load(persist_dir)
+
+    def _load(self, persist_dir: str) -> None:
+        with open(os.path.join(persist_dir, IVF_IDS_FILE), 'r') as f:
+            ids = json.load(f)
+        self._node_ids = ids['node_ids']
+        self._ref_doc_ids = ids['ref_doc_ids']
+        self._num_trained = ids['num_trained']
+        self._saved_vectors = np.load(os.path.join(persist_dir,
+                                                   IVF_VECTORS_FILE),
+                                      mmap_mode='r')
+        self._added_vectors = None
+        self._deleted = np.zeros(len(self._node_ids), dtype=bool)
+        centroids_path = os.path.join(persist_dir, IVF_CENTROIDS_FILE)
+        if os.path.exists(centroids_path) and self._num_trained > 0:
+            self._centroids = np.load(centroids_path)
+            self._assignments = np.zeros(0, dtype=np.int32)
+            self._clusters = [
+                np.zeros(0, dtype=np.int64) for _ in self._centroids
+            ]
+            self._assign(
+                0, np.load(os.path.join(persist_dir, IVF_ASSIGNMENTS_FILE)))
+
+    def _get_vectors(self, indices: np.ndarray) -> np.ndarray:
+        num_saved = 0 if self._saved_vectors is None else len(
+            self._saved_vectors)
+        in_saved = indices < num_saved
+        if in_saved.all():
+            return np.asarray(self._saved_vectors[indices])
+        added = self._added_vectors[indices[~in_saved] - num_saved]
+        if not in_saved.any():
+            return added
+        vectors = np.empty((len(indices), added.shape[1]), dtype=np.float32)
+        vectors[in_saved] = self._saved_vectors[indices[in_saved]]
+        vectors[~in_saved] = added
+        return vectors
+
+    def _train(self) -> None:
+        '''Clusters a sample of the embeddings and assigns every embedding to
+        its nearest cluster.
+        '''
+        rng = np.random.default_rng(0)
+        live = np.flatnonzero(~self._deleted)
+        num_clusters = max(1, int(4 * np.sqrt(len(live))))
+        num_samples = min(len(live), num_clusters * KMEANS_SAMPLES_PER_CLUSTER)
+        samples = np.sort(rng.choice(live, num_samples, replace=False))
+        self._centroids = _kmeans(self._get_vectors(samples), num_clusters,
+                                  rng)
+
+        all_indices = np.arange(len(self._node_ids))
+        assignments = np.concatenate([
+            _nearest_centroids(
+                self._get_vectors(all_indices[i:i + ASSIGN_CHUNK_SIZE]),
+                self._centroids)
+            for i in range(0, len(all_indices), ASSIGN_CHUNK_SIZE)
+        ])
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._clusters = [
+            np.zeros(0, dtype=np.int64) for _ in range(num_clusters)
+        ]
+        self._assign(0, assignments)
+        self._num_trained = len(self._node_ids)
+
+    def _assign(self, start: int, assignments: np.ndarray) -> None:
+        '''Adds the embeddings from index `start` onwards to the clusters.
+        '''
+        self._assignments = np.concatenate([self._assignments, assignments])
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=len(self._clusters))
+        splits = np.split(order + start, np.cumsum(counts)[:-1])
+        for cluster, indices in enumerate(splits):
+            if len(indices):
+                self._clusters[cluster] = np.concatenate(
+                    [self._clusters[cluster], indices])